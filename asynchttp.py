@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+#
+# asynchttp.py
+# Non-blocking HTTP requests on a single asyncore event loop, with tasks
+# written as generators so many requests can be in flight at once
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import sys
+import time
+import types
+import socket
+import httplib
+import urllib2
+import asyncore
+import urlparse
+import cookielib
+import StringIO
+import collections
+import transport
+
+class Pending:
+    """
+    A result that isn't ready yet, such as a request in progress or a Task.
+    """
+
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.error = None
+        self.__callbacks = []
+
+    def add_callback(self, callback):
+        """
+        Call callback(value, error) once the result is ready (straight away if it already is).
+        """
+        if self.done:
+            callback(self.value, self.error)
+        else:
+            self.__callbacks += [callback]
+
+    def result(self):
+        """
+        Returns the value, or raises the error, of a finished result.
+        """
+        if not self.done:
+            raise RuntimeError('Result is not ready yet, run the event loop first')
+        if self.error:
+            raise self.error
+        return self.value
+
+    def resolve(self, value=None, error=None):
+        self.done = True
+        self.value = value
+        self.error = error
+        callbacks = self.__callbacks
+        self.__callbacks = []
+        for callback in callbacks:
+            callback(value, error)
+
+class Return:
+    """
+    Yield Return(value) from a task's generator to finish it with a value.
+    """
+
+    def __init__(self, value=None):
+        self.value = value
+
+class Task(Pending):
+    """
+    Runs a generator as a task on the event loop. The generator yields
+    Pending results (requests or other tasks) or other generators, and is
+    resumed with their value, or has their error raised inside it, when they
+    are ready. It finishes by yielding Return(value) or just stopping.
+    """
+
+    def __init__(self, generator, callback=None):
+        Pending.__init__(self)
+        if callback:
+            self.add_callback(callback)
+        self.__stack = [generator]
+        self.__step(None, None)
+
+    def __step(self, value, error):
+        while True:
+            generator = self.__stack[-1]
+            try:
+                if error:
+                    yielded = generator.throw(error)
+                else:
+                    yielded = generator.send(value)
+            except StopIteration:
+                yielded = Return()
+            except Exception, e:
+                # Pass the error up to the generator that called this one
+                self.__stack.pop()
+                if not self.__stack:
+                    self.resolve(None, e)
+                    return
+                value, error = None, e
+                continue
+
+            if isinstance(yielded, Return):
+                generator.close()
+                self.__stack.pop()
+                if not self.__stack:
+                    self.resolve(yielded.value)
+                    return
+                value, error = yielded.value, None
+            elif isinstance(yielded, types.GeneratorType):
+                self.__stack.append(yielded)
+                value, error = None, None
+            elif isinstance(yielded, Pending):
+                yielded.add_callback(self.__step)
+                return
+            else:
+                value, error = None, TypeError('Tasks can only yield Pending results, generators or Return')
+
+class _Connection(asyncore.dispatcher):
+    # One request and its response over a connection the server closes when done
+
+    def __init__(self, client, request):
+        asyncore.dispatcher.__init__(self, map=client.socket_map)
+        self.client = client
+        self.request = request
+        self.started = time.time()
+        self.finished = False
+        self.__outgoing = collections.deque(request.pieces)
+        self.__incoming = []
+
+    def start(self):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((self.request.host, self.request.port))
+
+    def writable(self):
+        return not self.connected or bool(self.__outgoing)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        piece = self.__outgoing[0]
+        if hasattr(piece, 'read'):
+            # Read files a chunk at a time as the socket is ready for them
+            chunk = piece.read(64 * 1024)
+            if not chunk:
+                self.__outgoing.popleft()
+                return
+            self.__outgoing.appendleft(chunk)
+            piece = chunk
+        sent = self.send(piece)
+        if sent < len(piece):
+            self.__outgoing[0] = piece[sent:]
+        else:
+            self.__outgoing.popleft()
+
+    def handle_read(self):
+        self.__incoming.append(self.recv(64 * 1024))
+
+    def handle_close(self):
+        self.close()
+        if self.finished:
+            return
+        try:
+            response = self.__parse_response(''.join(self.__incoming))
+        except Exception, e:
+            self.fail(e)
+            return
+        self.finished = True
+        self.client._finished(self, response, None)
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def fail(self, error):
+        self.close()
+        if not self.finished:
+            self.finished = True
+            self.client._finished(self, None, error)
+
+    def __parse_response(self, data):
+        header_end = data.find('\r\n\r\n')
+        if header_end == -1:
+            raise httplib.BadStatusLine(data[:100])
+        status_line, header_text = (data[:header_end] + '\r\n').split('\r\n', 1)
+        version, code, reason = (status_line.split(' ', 2) + [''])[:3]
+        headers = httplib.HTTPMessage(StringIO.StringIO(header_text))
+        body = data[header_end + 4:]
+        if (headers.getheader('transfer-encoding') or '').lower() == 'chunked':
+            body = _unchunk(body)
+        body = transport.decode_body(body, headers.getheader('content-encoding'))
+        return transport.HttpResponse(self.request.url, int(code), reason.strip(), headers, body)
+
+def _unchunk(body):
+    # Decode a body sent with Transfer-Encoding: chunked
+    pieces = []
+    position = 0
+    while True:
+        line_end = body.index('\r\n', position)
+        size = int(body[position:line_end].split(';')[0], 16)
+        if size == 0:
+            return ''.join(pieces)
+        pieces.append(body[line_end + 2:line_end + 2 + size])
+        position = line_end + 2 + size + 2
+
+class _Request(Pending):
+    # A request waiting to be sent or in progress
+
+    def __init__(self, method, url, pieces, headers, redirects):
+        Pending.__init__(self)
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('Only http urls are supported: %s' % (url))
+        self.method = method
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = (parts.path or '/') + (parts.query and '?' + parts.query or '')
+        self.headers = headers
+        self.body = pieces
+        self.redirects = redirects
+        self.pieces = []
+
+class AsyncHttpClient:
+    """
+    Sends HTTP requests without blocking, all driven by one asyncore event
+    loop which is run with run(). At most max_connections requests are in
+    flight at once, and at most max_per_host to any one host, the rest wait
+    their turn. Cookies are kept in a cookielib.CookieJar and gzip or deflate
+    responses are decompressed, as with transport.HttpTransport.
+    Host names are looked up with the normal blocking resolver.
+    """
+
+    def __init__(self, cookiejar=None, max_connections=8, max_per_host=4, timeout=60, max_redirects=5):
+        if cookiejar is None:
+            cookiejar = cookielib.CookieJar()
+        self.cookiejar = cookiejar
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.socket_map = {}
+
+        self.__waiting = collections.deque()
+        self.__active = []
+
+    def open(self, url, data=None, headers=None):
+        """
+        Start a GET of the url, or a POST of data if given, and return a
+        Pending result for the transport.HttpResponse. Error statuses give
+        urllib2.HTTPError as with urllib2.urlopen.
+        """
+        if data is None:
+            return self.request('GET', url, None, headers)
+        all_headers = { 'Content-Type': 'application/x-www-form-urlencoded' }
+        all_headers.update(headers or {})
+        return self.request('POST', url, data, all_headers)
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Start a request and return a Pending result for the response.
+        body may be a string or a list of strings and file-like objects.
+        """
+        if body is None:
+            pieces = []
+        elif isinstance(body, list):
+            pieces = body
+        else:
+            pieces = [body]
+        request = _Request(method, url, pieces, headers or {}, self.max_redirects)
+        self.__waiting.append(request)
+        self.__start_waiting()
+        return request
+
+    def spawn(self, generator, callback=None):
+        """
+        Start a Task running the generator on this client's event loop.
+        """
+        return Task(generator, callback)
+
+    def run(self, until=None):
+        """
+        Run the event loop until every request has finished, or until the
+        Pending result until is done.
+        """
+        while self.__active or self.__waiting:
+            if until is not None and until.done:
+                break
+            asyncore.loop(timeout=0.2, map=self.socket_map, count=1)
+            self.__check_timeouts()
+        if until is not None:
+            return until.result()
+
+    def _finished(self, connection, response, error):
+        # Called by a connection when its request is complete
+        self.__active.remove(connection)
+        request = connection.request
+
+        if response is not None:
+            self.cookiejar.extract_cookies(response, urllib2.Request(request.url))
+            location = response.headers.getheader('location')
+            if response.code in (301, 302, 303, 307) and location and request.redirects > 0:
+                # Follow the redirect, turning a POST into a GET as browsers do
+                url = urlparse.urljoin(request.url, location)
+                if response.code == 307:
+                    redirected = _Request(request.method, url, request.body, request.headers, request.redirects - 1)
+                else:
+                    headers = dict([(name, value) for name, value in request.headers.items()
+                                    if name.lower() not in ('content-type', 'content-length')])
+                    redirected = _Request('GET', url, [], headers, request.redirects - 1)
+                redirected.add_callback(request.resolve)
+                self.__waiting.appendleft(redirected)
+                response = None
+            elif response.code >= 400:
+                error = urllib2.HTTPError(request.url, response.code, response.msg, response.headers, StringIO.StringIO(response.body))
+                response = None
+
+        self.__start_waiting()
+        if response is not None or error is not None:
+            request.resolve(response, error)
+
+    def __start_waiting(self):
+        # Start as many waiting requests as the limits allow
+        skipped = []
+        while self.__waiting and len(self.__active) < self.max_connections:
+            request = self.__waiting.popleft()
+            if len([1 for connection in self.__active if connection.request.host == request.host]) >= self.max_per_host:
+                skipped.append(request)
+                continue
+            self.__prepare(request)
+            connection = _Connection(self, request)
+            try:
+                connection.start()
+            except Exception, e:
+                connection.close()
+                request.resolve(None, e)
+                continue
+            self.__active.append(connection)
+        self.__waiting.extendleft(reversed(skipped))
+
+    def __prepare(self, request):
+        # Build the request line and headers now the cookies are up to date
+        cookie_request = urllib2.Request(request.url)
+        self.cookiejar.add_cookie_header(cookie_request)
+
+        host = request.host
+        if request.port != 80:
+            host += ':%d' % (request.port)
+        headers = { 'Host': host, 'Accept-Encoding': 'gzip, deflate', 'Connection': 'close' }
+        headers.update(cookie_request.unredirected_hdrs)
+        headers.update(request.headers)
+        if request.body:
+            headers['Content-Length'] = str(sum([transport.body_length(piece) for piece in request.body]))
+
+        head = '%s %s HTTP/1.1\r\n' % (request.method, request.path)
+        head += ''.join(['%s: %s\r\n' % (name, value) for name, value in headers.items()])
+        head += '\r\n'
+        request.pieces = [head] + list(request.body)
+
+    def __check_timeouts(self):
+        now = time.time()
+        for connection in list(self.__active):
+            if now - connection.started > self.timeout:
+                connection.fail(socket.timeout('Timed out requesting %s' % (connection.request.url)))
+
+if __name__ == '__main__':
+    # Fetch a few pages at once
+    client = AsyncHttpClient()
+    def fetch(url):
+        response = yield client.open(url)
+        yield Return(len(response.read()))
+    tasks = [client.spawn(fetch('http://www.reddit.com/search.json?q=%s' % (query))) for query in ('kant', 'hume', 'locke')]
+    client.run()
+    for task in tasks:
+        print(task.error or '%d bytes' % (task.value))
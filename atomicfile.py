@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# atomicfile.py
+# Replaces a file in one step so a crash leaves either the old file or the
+# new one, never a partly written one or none at all, and trims the partial
+# last line a crash can leave in a file that is appended to
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import sys
+
+# MoveFileEx flags, see the Windows API documentation
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+def write(filename, writer):
+    """
+    Replace filename with what writer writes to the file object it is
+    passed. It is written to a temporary file which is synced to disk and
+    then renamed over filename.
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as temp:
+        writer(temp)
+        temp.flush()
+        os.fsync(temp.fileno())
+    rename(temp_filename, filename)
+
+def rename(source, destination):
+    """
+    Rename source to destination, replacing destination if it exists.
+    """
+    if sys.platform != 'win32':
+        os.rename(source, destination)
+        return
+
+    # os.rename will not replace an existing file on Windows but MoveFileEx
+    # can, without a moment where neither file is there
+    import ctypes
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(source), unicode(destination),
+                                              MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+        raise ctypes.WinError()
+
+def trim_partial_line(filename):
+    """
+    Cut filename back to the end of its last complete line, so a line left
+    partly written by a crash isn't joined onto the next one appended.
+    Does nothing if the file doesn't exist.
+    """
+    try:
+        log = open(filename, 'r+b')
+    except IOError:
+        return
+
+    with log:
+        log.seek(0, os.SEEK_END)
+        end = log.tell()
+        size = end
+        while end > 0:
+            start = max(0, end - 4096)
+            log.seek(start)
+            newline = log.read(end - start).rfind('\n')
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            log.truncate(end)
+            log.flush()
+            os.fsync(log.fileno())
+
+if __name__ == '__main__':
+    # Write a file twice, the second replacing the first
+    import tempfile
+    filename = os.path.join(tempfile.mkdtemp(prefix='atomicfile'), 'test.txt')
+    for text in ('first', 'second'):
+        write(filename, lambda output: output.write(text))
+        with open(filename, 'rb') as written:
+            print("%s: %s" % (filename, written.read()))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# backfill.py
+# Catches up on the links posted while ric wasn't running by paging through
+# the whole search window, with a checkpoint so it can be interrupted
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import sys
+import copy
+import atomicfile
+
+try:
+    import json
+except:
+    print("Failed to load json, requires Python 2.6 or later")
+    sys.exit(1)
+
+class Backfill:
+    """
+    Pages through everything the searches find in a window (see
+    reddit.LINKS_FROM_SECONDS), newest first, one page each time
+    next_links() is called. Where each search has got to is saved to a
+    checkpoint file by checkpoint(), once the links returned so far have
+    been dealt with, so an interrupted backfill carries on from there.
+    The checkpoint is removed once every search has been paged through.
+    """
+
+    def __init__(self, queries, links_from='day', filename=None, limit=100, accept_domain=None):
+        """
+        Pass the search query or a list of queries, the window to page
+        through and the checkpoint file, or None to not keep one. Pass
+        accept_domain to only return links for some domains (see
+        RedditApi.search).
+        """
+        if isinstance(queries, basestring):
+            queries = [queries]
+        self.queries = list(queries)
+        self.links_from = links_from
+        self.filename = filename
+        self.limit = limit
+        self.accept_domain = accept_domain
+        self.pages = 0
+        self.links = 0
+
+        # query -> { 'after': fullname to carry on after, 'done': True once paged through }
+        # for how far the searches have got and how far the checkpoint says
+        self.__saved = {}
+        self.__load()
+        self.resumed = bool(self.__saved)
+        self.__progress = copy.deepcopy(self.__saved)
+
+    def finished(self):
+        """
+        Returns True once every search has been paged through.
+        """
+        for query in self.queries:
+            if not self.__progress.get(query, {}).get('done'):
+                return False
+        return True
+
+    def next_links(self, reddit):
+        """
+        Fetch the next page of the first search that isn't finished using a
+        reddit.RedditApi and return its RedditLinks, or [] once finished.
+        """
+        for query in self.queries:
+            progress = self.__progress.setdefault(query, { 'after': None, 'done': False })
+            if progress['done']:
+                continue
+            links, after = reddit.search_page(query, 'new', self.links_from, self.limit, progress['after'], self.accept_domain)
+            progress['after'] = after
+            progress['done'] = after is None
+            self.pages += 1
+            self.links += len(links)
+            return links
+        return []
+
+    def checkpoint(self):
+        """
+        Save how far the searches have got, call this once the links
+        returned so far are safely in the pipeline.
+        """
+        self.__saved = copy.deepcopy(self.__progress)
+        if not self.filename:
+            return
+        if self.finished():
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            return
+
+        atomicfile.write(self.filename, lambda checkpoint: json.dump({ 'links_from': self.links_from,
+                                                                       'progress': self.__saved }, checkpoint))
+
+    def __str__(self):
+        return 'backfill of the last %s: %d pages, %d links%s' % (self.links_from, self.pages, self.links,
+                                                                 self.finished() and ', finished' or '')
+
+    def __load(self):
+        # Carry on from a checkpoint of a backfill over the same window
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, 'rb') as checkpoint:
+                saved = json.load(checkpoint)
+        except (IOError, ValueError):
+            return
+        if saved.get('links_from') != self.links_from:
+            return
+        for query, progress in saved.get('progress', {}).items():
+            if query in self.queries:
+                self.__saved[query] = progress
+
+if __name__ == '__main__':
+    # Page through a day of craigslist links, a few pages at a time
+    import tempfile
+    import reddit
+    filename = os.path.join(tempfile.mkdtemp(prefix='backfill'), 'backfill.json')
+    api = reddit.RedditApi(None, None)
+    for run in range(2):
+        backfill = Backfill('craigslist.org', 'day', filename, limit=25)
+        print("Resumed: %s" % (backfill.resumed))
+        for page in range(2):
+            print("%d links" % (len(backfill.next_links(api))))
+            backfill.checkpoint()
+        print(backfill)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+#
+# benchmark.py
+# Measure how fast ric processes links, offline, by running the pipeline
+# against local stand-ins for reddit.com, imgur.com and craigslist
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import re
+import sys
+import copy
+import time
+import shutil
+import socket
+import urlparse
+import optparse
+import tempfile
+import resource
+import threading
+import SocketServer
+import BaseHTTPServer
+import ric
+import imgur
+import reddit
+import webshot
+import pipeline
+import linkstore
+import preflight
+import scheduler
+import transport
+import renderpool
+
+try:
+    import json
+except:
+    print("Failed to load json, requires Python 2.6 or later")
+    sys.exit(1)
+
+# Hosts the apis talk to which are sent to the stand-ins instead
+FAKE_HOSTS = ('www.reddit.com', 'reddit.com', 'imgur.com')
+
+# Sizes of the generated craigslist pages in KB, used in turn
+PAGE_SIZES = (2, 20, 200)
+
+class FakeSites:
+    """
+    Local HTTP stand-ins for reddit.com (search, login, user details and comments),
+    imgur.com (uploads) and craigslist (generated posts of various sizes),
+    all served from one port on a background thread.
+    Reddit's search finds the given number of craigslist links plus one
+    link elsewhere for every four, every tenth craigslist link is a
+    repost of an earlier page and every seventh page has been deleted.
+    The links all exist from the start unless posts_per_minute is given,
+    in which case they turn up one at a time.
+    The reddit and imgur replies are delayed by api_latency seconds to
+    stand in for the network.
+    """
+
+    def __init__(self, links=50, posts_per_minute=0, api_latency=0.05, username='ric'):
+        self.api_latency = api_latency
+        self.username = username
+        self.comments = 0
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.started = time.time()
+        self.__lock = threading.Lock()
+
+        # Reddit posts oldest first, as (time posted, fullname, link json)
+        self.posts = []
+        craigslist = 0
+        number = 0
+        while craigslist < links:
+            number += 1
+            if number % 5 == 0:
+                url, domain = 'http://www.example.com/%d' % (number), 'example.com'
+            else:
+                craigslist += 1
+                post = craigslist
+                if craigslist % 10 == 0:
+                    post = craigslist - 5
+                url, domain = '/sfc/apa/%d.html' % (post), 'sfbay.craigslist.org'
+            fullname = 't3_%x' % (number)
+            posted = posts_per_minute and (number - 1) * 60.0 / posts_per_minute or 0
+            self.posts += [(posted, fullname, { 'title': 'Benchmark post %d' % (number), 'url': url,
+                                                'subreddit': 'benchmark', 'domain': domain,
+                                                'id': fullname[3:], 'name': fullname })]
+
+        # Counting the links elsewhere, all of them must fit in one search
+        if len(self.posts) > 100 and not posts_per_minute:
+            raise ValueError('Reddit only returns 100 links per search and %d links makes %d posts, '
+                             'pass posts_per_minute to benchmark more' % (links, len(self.posts)))
+
+        fake_sites = self
+        class Handler(_FakeSitesHandler):
+            sites = fake_sites
+        self.server = _ThreadingServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % (self.server.server_address[1])
+
+        # The craigslist links need to point at the server now we know its port
+        for posted, fullname, link in self.posts:
+            if link['url'].startswith('/'):
+                link['url'] = self.url + link['url']
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def listing(self, params):
+        """
+        Returns a page of the search listing, newest first, honouring limit, before and after.
+        """
+        now = time.time() - self.started
+        newest = [(fullname, link) for posted, fullname, link in reversed(self.posts) if posted <= now]
+        fullnames = [fullname for fullname, link in newest]
+        limit = int(params.get('limit', 25))
+        if params.get('before') in fullnames:
+            end = fullnames.index(params['before'])
+            page = newest[max(0, end - limit):end]
+        elif params.get('after') in fullnames:
+            start = fullnames.index(params['after']) + 1
+            page = newest[start:start + limit]
+        else:
+            page = newest[:limit]
+
+        after = None
+        if page and page[-1][0] != fullnames[-1]:
+            after = page[-1][0]
+        return json.dumps({ 'kind': 'Listing',
+                            'data': { 'modhash': '',
+                                      'children': [{ 'kind': 't3', 'data': link } for fullname, link in page],
+                                      'after': after,
+                                      'before': None }})
+
+    def page(self, post):
+        """
+        Returns a craigslist-like post, the size depends on the post number
+        and every seventh post has been deleted.
+        """
+        size = PAGE_SIZES[post % len(PAGE_SIZES)] * 1024
+        head = '<html><head><title>Benchmark apartment %d</title></head><body>' % (post)
+        if post % 7 == 0:
+            return head + '<h2>%s.</h2></body></html>' % (preflight.CRAIGSLIST_REMOVED[0])
+        head += '<h2>$%d / %dbr - Benchmark apartment %d</h2><div id="userbody">' % (1000 + post, post % 4 + 1, post)
+        tail = '</div><ul class="blurbs"><li>it\'s NOT ok to contact this poster with services</li></ul></body></html>'
+        paragraph = '<p>Sunny apartment %d close to transit, laundry in building, cats ok. ' % (post)
+        paragraph += 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor.</p>\n'
+        count = max(1, (size - len(head) - len(tail)) / len(paragraph))
+        return head + paragraph * count + tail
+
+    def record(self, counter, amount=1):
+        with self.__lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The preflight check hangs up once it has read the start of a page
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class _FakeSitesHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Answers requests for all of the fake sites, keeping connections alive
+    protocol_version = 'HTTP/1.1'
+    sites = None
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        if parts.path == '/search.json':
+            time.sleep(self.sites.api_latency)
+            self.reply(self.sites.listing(dict(urlparse.parse_qsl(parts.query))), 'application/json')
+        elif parts.path == '/api/me.json':
+            time.sleep(self.sites.api_latency)
+            self.reply(json.dumps({ 'kind': 't2', 'data': { 'name': self.sites.username, 'modhash': 'benchmark' }}), 'application/json')
+        elif re.match(r'/sfc/apa/\d+\.html$', parts.path):
+            self.reply(self.sites.page(int(re.search(r'\d+', parts.path).group(0))))
+        else:
+            self.reply('Not found', code=404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        time.sleep(self.sites.api_latency)
+        if self.path == '/post/login':
+            self.reply("reddit = { logged: '%s', modhash: 'benchmark' }" % (self.sites.username),
+                       headers={ 'Set-Cookie': 'reddit_session=benchmark; Path=/' })
+        elif self.path == '/api/comment':
+            self.sites.record('comments')
+            self.reply('{"jquery": []}', 'application/json')
+        elif self.path == '/api/upload.json':
+            self.sites.record('uploads')
+            self.sites.record('upload_bytes', len(body))
+            self.reply(json.dumps({ 'rsp': { 'stat': 'ok', 'image': { 'imgur_page': 'http://imgur.com/bench%d' % (self.sites.uploads) }}}),
+                       'application/json')
+        else:
+            self.reply('Not found', code=404)
+
+    def reply(self, body, content_type='text/html', code=200, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class LocalTransport(transport.HttpTransport):
+    """
+    An HttpTransport that sends requests for reddit.com and imgur.com to a
+    local server instead, so the apis can be used unchanged.
+    """
+
+    def __init__(self, local_url, *args, **kwargs):
+        transport.HttpTransport.__init__(self, *args, **kwargs)
+        self.local_url = local_url
+
+    def request(self, method, url, body=None, headers=None, max_bytes=None):
+        parts = urlparse.urlsplit(url)
+        if parts.hostname in FAKE_HOSTS:
+            url = self.local_url + url[len(parts.scheme) + 3 + len(parts.netloc):]
+        return transport.HttpTransport.request(self, method, url, body, headers, max_bytes)
+
+def peak_rss():
+    """
+    Returns the peak resident memory in KB of this process and of the
+    largest child process (such as a render worker) that has exited.
+    """
+    this = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return this, children
+
+def run(links=50, processes=2, posts_per_minute=0, api_latency=0.05, timeout_seconds=600):
+    """
+    Run the whole pipeline against the fake sites until every craigslist
+    link has been posted (or timeout_seconds have passed) and return the
+    results as a dictionary.
+    Pass processes=0 to render in this process as ric.py can.
+    """
+    sites = FakeSites(links, posts_per_minute, api_latency)
+    http = LocalTransport(sites.url)
+
+    # Start with an empty cache so runs can be compared
+    cache_directory = tempfile.mkdtemp(prefix='ric-benchmark-')
+    policy = copy.copy(ric.load_policy)
+    policy.cache_directory = cache_directory
+    if processes:
+        renderer = renderpool.RendererPool(processes, options=ric.image_options, policy=policy)
+    else:
+        renderer = webshot.WebshotRenderer(ric.image_options, policy)
+
+    processed = linkstore.LinkStore()
+    links_pipeline = pipeline.Pipeline(reddit.RedditApi(sites.username, 'benchmark', http), imgur.ImgurApi('benchmark', http),
+                                       renderer, processed, ric.watched_sites.queries(), ric.watched_sites.accepts_link,
+                                       renderers=max(processes, 1), comment_interval=0,
+                                       poll_schedule=scheduler.PollScheduler(1, 5),
+                                       accept_domain=ric.watched_sites.accepts_domain,
+                                       options_for=ric.watched_sites.options_for,
+                                       preflight=ric.removed_markers and preflight.PreflightChecker(http, ric.removed_markers, ric.preflight_bytes))
+
+    # Stop the pipeline once every link is done so it drains and returns
+    started = time.time()
+    def watch():
+        while len(processed) < links and time.time() - started < timeout_seconds:
+            time.sleep(0.1)
+        links_pipeline.stop()
+    watcher = threading.Thread(target=watch)
+    watcher.setDaemon(True)
+    watcher.start()
+
+    links_pipeline.run()
+    elapsed = time.time() - started
+    if processes:
+        renderer.close()
+    http.close()
+    sites.close()
+    shutil.rmtree(cache_directory, True)
+    rss, worker_rss = peak_rss()
+
+    stages = {}
+    for stage, counter in links_pipeline.counters.items():
+        stages[stage] = { 'completed': counter.completed,
+                          'failed': counter.failed,
+                          'p50_seconds': counter.percentile(0.5),
+                          'p95_seconds': counter.percentile(0.95) }
+    return { 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'python': sys.version.split()[0],
+             'settings': { 'links': links, 'processes': processes, 'posts_per_minute': posts_per_minute,
+                           'api_latency': api_latency },
+             'links_processed': len(processed),
+             'seconds': elapsed,
+             'links_per_minute': len(processed) * 60.0 / max(elapsed, 0.001),
+             'stages': stages,
+             'uploads': sites.uploads,
+             'upload_kb': sites.upload_bytes / 1024.0,
+             'comments': sites.comments,
+             'upload_cache': { 'hits': links_pipeline.upload_cache.hits, 'misses': links_pipeline.upload_cache.misses },
+             'peak_rss_kb': rss,
+             'peak_worker_rss_kb': worker_rss }
+
+def describe(results, previous=None):
+    """
+    Returns a summary of benchmark results, with the change from previous results if given.
+    """
+    def line(name, value, old_value, format):
+        text = '%-24s' % (name) + format % (value)
+        if old_value:
+            text += ' (%+.1f%%)' % ((value - old_value) * 100.0 / old_value)
+        return text
+
+    def lookup(results, keys):
+        for key in keys:
+            if not results or key not in results:
+                return None
+            results = results[key]
+        return results
+
+    metrics = [('links/minute', ['links_per_minute'], '%.1f')]
+    for stage in pipeline.STAGES:
+        metrics += [('%s p50 seconds' % (stage), ['stages', stage, 'p50_seconds'], '%.3f'),
+                    ('%s p95 seconds' % (stage), ['stages', stage, 'p95_seconds'], '%.3f')]
+    metrics += [('peak rss KB', ['peak_rss_kb'], '%d'),
+                ('peak worker rss KB', ['peak_worker_rss_kb'], '%d')]
+
+    lines = ['%d of %d links in %.1fs, %d uploads, %d comments' % (results['links_processed'], results['settings']['links'],
+                                                                   results['seconds'], results['uploads'], results['comments'])]
+    for name, keys, format in metrics:
+        lines += [line(name, lookup(results, keys), lookup(previous, keys), format)]
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description='Benchmark ric against local stand-ins for reddit, imgur and craigslist.')
+    parser.add_option('-n', '--links', type='int', default=50, help='number of craigslist links to process [%default]')
+    parser.add_option('-p', '--processes', type='int', default=ric.render_processes,
+                      help='render worker processes, 0 to render in this process [%default]')
+    parser.add_option('-r', '--rate', type='float', default=0,
+                      help='posts per minute turning up on reddit, 0 for all at the start [%default]')
+    parser.add_option('-l', '--latency', type='float', default=0.05, help='seconds reddit and imgur take to answer [%default]')
+    parser.add_option('-t', '--timeout', type='int', default=600, help='seconds to give up after [%default]')
+    parser.add_option('-o', '--output', default='benchmark.json', help='file to save the results to as json [%default]')
+    parser.add_option('-c', '--compare', help='earlier results to compare with')
+    options, args = parser.parse_args()
+
+    previous = None
+    if options.compare:
+        with open(options.compare, 'rb') as results_file:
+            previous = json.load(results_file)
+
+    results = run(options.links, options.processes, options.rate, options.latency, options.timeout)
+    with open(options.output, 'wb') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    print(describe(results, previous))
+    print("Results saved to %s" % (options.output))
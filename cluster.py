@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+#
+# cluster.py
+# Lets several ric processes share the work through a sqlite database,
+# splitting links between them by consistent hashing with leases, and
+# funnelling every comment through one poster
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import sys
+import time
+import bisect
+import socket
+import hashlib
+import sqlite3
+import threading
+import reddit
+import journal
+import scheduler
+import uploadcache
+
+try:
+    import json
+except:
+    print("Failed to load json, requires Python 2.6 or later")
+    sys.exit(1)
+
+# The lease held by the worker that posts every comment
+POSTER_LEASE = 'role:poster'
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, heartbeat REAL)',
+          'CREATE TABLE IF NOT EXISTS links (fullname TEXT PRIMARY KEY, link TEXT, page TEXT, added REAL)',
+          'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, worker TEXT, expires REAL)',
+          'CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, processed_at REAL)',
+          'CREATE TABLE IF NOT EXISTS comments (fullname TEXT PRIMARY KEY, link TEXT, imgur_link TEXT, '
+          'queued REAL, attempts INTEGER, retry_at REAL, error TEXT)',
+          'CREATE TABLE IF NOT EXISTS posters (worker TEXT PRIMARY KEY, posted_at REAL)')
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+def _link_json(link):
+    return json.dumps(dict([(name, getattr(link, name)) for name in journal.LINK_FIELDS]))
+
+def _json_link(text):
+    fields = json.loads(text)
+    return reddit.RedditLink(*[fields[name] for name in journal.LINK_FIELDS])
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes. Each node is put at replicas
+    points around a ring and a key belongs to the next node round from
+    where it lands, so keys are spread evenly and a node joining or leaving
+    only moves the keys next to its own points.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.nodes = sorted(set(nodes))
+        self.replicas = replicas
+        points = []
+        for node in self.nodes:
+            for replica in range(replicas):
+                points += [(_hash('%s#%d' % (node, replica)), node)]
+        points.sort()
+        self.__hashes = [point for point, node in points]
+        self.__nodes = [node for point, node in points]
+
+    def owner(self, key):
+        """
+        Returns the node a key belongs to, or None if there are no nodes.
+        """
+        if not self.__hashes:
+            return None
+        return self.__nodes[bisect.bisect(self.__hashes, _hash(key)) % len(self.__hashes)]
+
+class _Database:
+    # A sqlite connection shared by the threads of one process, other
+    # processes wait on sqlite's own locks for up to timeout seconds
+    # This keeps sqlite's default rollback journal, a write-ahead log
+    # needs shared memory which workers on other hosts can't see
+
+    def __init__(self, filename, timeout=60):
+        self.connection = sqlite3.connect(filename, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def execute(self, sql, *args):
+        """
+        Run one statement and return its rows.
+        """
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def change(self, sql, *args):
+        """
+        Run one statement and return the number of rows it changed.
+        """
+        with self.lock:
+            return self.connection.execute(sql, args).rowcount
+
+    def transaction(self, function):
+        """
+        Call function with the connection inside a transaction which holds
+        the write lock from the start, so what it reads can't change under it.
+        """
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(self.connection)
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return result
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class Coordinator:
+    """
+    Shares the work of several ric processes (workers) through a sqlite
+    database, which they can all open on one host, or on several hosts
+    with a network file system whose locks work.
+    Every worker offers the links it finds and takes the ones it owns: the
+    links whose canonical page url hashes to it on a HashRing of the
+    workers with a recent heartbeat, so every post of a page goes to the
+    same worker. A worker holds a lease on each link while it works on it,
+    so links move to the others if it stops, and it never takes a link
+    another worker has a lease on while the ring changes.
+    Comments are queued in the database and posted by whichever worker
+    holds the poster lease, so reddit only sees one poster, and when it
+    last posted is kept there too so a new poster waits its turn.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self, filename, worker=None, poster=True, lease_seconds=30 * 60, heartbeat_interval=30,
+                 max_age=2 * 24 * 60 * 60, max_attempts=5):
+        """
+        Open (or create) the database in filename. worker is this worker's
+        name, which must be unique and should stay the same between runs,
+        by default the host name and process id. Pass poster=False for a
+        worker that must never post, such as one in dry-run mode.
+        Links and dead comments older than max_age seconds are forgotten.
+        """
+        if worker is None:
+            worker = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.filename = filename
+        self.worker = worker
+        self.poster = poster
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.database = _Database(filename)
+
+        self.ring = HashRing([worker])
+        self.__poster_until = 0
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        """
+        Join the workers, keeping our heartbeat going from a background thread.
+        """
+        self.heartbeat()
+        self.__thread = threading.Thread(target=self.__beat_forever)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Leave the workers so the others take over our links and posting.
+        Leases on links in progress are left to expire.
+        """
+        self.__stopping.set()
+        if self.__thread:
+            while self.__thread.isAlive():
+                self.__thread.join(0.5)
+        self.database.change('DELETE FROM workers WHERE name = ?', self.worker)
+        self.database.change('DELETE FROM leases WHERE name = ? AND worker = ?', POSTER_LEASE, self.worker)
+        self.__poster_until = 0
+
+    def close(self):
+        self.database.close()
+
+    def heartbeat(self, now=None):
+        """
+        Tell the other workers we are alive, rebuild the ring from the live
+        workers and take or renew the poster lease if it is free.
+        """
+        if now is None:
+            now = time.time()
+        self.database.change('INSERT OR REPLACE INTO workers VALUES (?, ?)', self.worker, now)
+        self.ring = HashRing(self.workers(now))
+        if self.poster:
+            expires = now + 3 * self.heartbeat_interval
+            if self.__lease(POSTER_LEASE, now, expires):
+                self.__poster_until = expires
+            else:
+                self.__poster_until = 0
+
+    def workers(self, now=None):
+        """
+        Returns the names of the workers with a recent heartbeat, including this one.
+        """
+        if now is None:
+            now = time.time()
+        rows = self.database.execute('SELECT name FROM workers WHERE heartbeat >= ?', now - 3 * self.heartbeat_interval)
+        return set([name for name, in rows] + [self.worker])
+
+    def is_poster(self):
+        """
+        Returns True while this worker holds the poster lease.
+        """
+        return self.__poster_until > time.time()
+
+    def offer(self, links):
+        """
+        Add RedditLinks found by a search for whichever worker owns them.
+        """
+        now = time.time()
+        rows = [(link.fullname, _link_json(link), uploadcache.canonical_url(link.href), now) for link in links]
+        if rows:
+            self.database.transaction(lambda connection: connection.executemany('INSERT OR IGNORE INTO links VALUES (?, ?, ?, ?)', rows))
+
+    def take(self, limit=100):
+        """
+        Returns up to limit of the offered RedditLinks that this worker owns
+        and nobody has a lease on or has processed, taking leases on them.
+        """
+        ring = self.ring
+        def take_links(connection):
+            now = time.time()
+            rows = connection.execute('SELECT links.fullname, links.link, links.page FROM links '
+                                      'LEFT JOIN leases ON leases.name = links.fullname '
+                                      'LEFT JOIN processed ON processed.key = links.fullname '
+                                      'WHERE (leases.name IS NULL OR leases.expires < ?) AND processed.key IS NULL '
+                                      'ORDER BY links.added', (now,)).fetchall()
+            mine = [(fullname, link) for fullname, link, page in rows if ring.owner(page) == self.worker][:limit]
+            connection.executemany('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                                   [(fullname, self.worker, now + self.lease_seconds) for fullname, link in mine])
+            return [_json_link(link) for fullname, link in mine]
+        return self.database.transaction(take_links)
+
+    def claim(self, link):
+        """
+        Take a lease on a RedditLink this worker already knows about, such
+        as one resumed from its journal. Returns False if another worker
+        has a lease on it.
+        """
+        now = time.time()
+        return self.__lease(link.fullname, now, now + self.lease_seconds)
+
+    def hold(self, link, until):
+        """
+        Keep the lease on a RedditLink until a time, such as when it is due to be retried.
+        """
+        self.database.change('UPDATE leases SET expires = ? WHERE name = ? AND worker = ?',
+                             until + self.lease_seconds, link.fullname, self.worker)
+
+    def release(self, link):
+        """
+        Give up the lease on a RedditLink so its owner can take it again.
+        """
+        self.database.change('DELETE FROM leases WHERE name = ? AND worker = ?', link.fullname, self.worker)
+
+    def done(self, link):
+        """
+        Forget a RedditLink that needs no more work, whether processed or given up on.
+        """
+        def forget(connection):
+            connection.execute('DELETE FROM links WHERE fullname = ?', (link.fullname,))
+            connection.execute('DELETE FROM leases WHERE name = ?', (link.fullname,))
+        self.database.transaction(forget)
+
+    def queue_comment(self, link, imgur_link):
+        """
+        Queue the comment for a RedditLink for the poster.
+        """
+        self.database.change('INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, 0, 0, NULL)',
+                             link.fullname, _link_json(link), imgur_link, time.time())
+
+    def next_comment(self):
+        """
+        Returns the oldest queued comment due to be posted as (link, imgur link), or None.
+        """
+        rows = self.database.execute('SELECT link, imgur_link FROM comments WHERE attempts < ? AND retry_at <= ? '
+                                     'ORDER BY queued LIMIT 1', self.max_attempts, time.time())
+        if not rows:
+            return None
+        link, imgur_link = rows[0]
+        return _json_link(link), imgur_link
+
+    def comment_posted(self, link):
+        def posted(connection):
+            connection.execute('DELETE FROM comments WHERE fullname = ?', (link.fullname,))
+            connection.execute('INSERT OR REPLACE INTO posters VALUES (?, ?)', (self.worker, time.time()))
+        self.database.transaction(posted)
+
+    def comment_failed(self, link, error):
+        """
+        Record that posting a comment failed, it is tried again after a
+        backoff. Returns True if it has now failed too often and is given up on.
+        """
+        def fail(connection):
+            rows = connection.execute('SELECT attempts FROM comments WHERE fullname = ?', (link.fullname,)).fetchall()
+            if not rows:
+                return True
+            attempts = rows[0][0] + 1
+            backoff = scheduler.Backoff(60)
+            backoff.failures = attempts - 1
+            connection.execute('UPDATE comments SET attempts = ?, retry_at = ?, error = ? WHERE fullname = ?',
+                               (attempts, time.time() + backoff.failed(), str(error), link.fullname))
+            connection.execute('INSERT OR REPLACE INTO posters VALUES (?, ?)', (self.worker, time.time()))
+            return attempts >= self.max_attempts
+        return self.database.transaction(fail)
+
+    def last_posted(self):
+        """
+        Returns when any worker last tried to post a comment, or 0 if none has.
+        """
+        return self.database.execute('SELECT MAX(posted_at) FROM posters')[0][0] or 0
+
+    def queued_comments(self):
+        """
+        Returns the number of comments waiting to be posted.
+        """
+        return self.database.execute('SELECT COUNT(*) FROM comments WHERE attempts < ?', self.max_attempts)[0][0]
+
+    def expire(self, now=None):
+        """
+        Forget links and dead comments older than max_age, expired leases and workers long gone.
+        """
+        if now is None:
+            now = time.time()
+        def expire_rows(connection):
+            if self.max_age:
+                connection.execute('DELETE FROM links WHERE added < ?', (now - self.max_age,))
+                connection.execute('DELETE FROM comments WHERE attempts >= ? AND queued < ?', (self.max_attempts, now - self.max_age))
+            connection.execute('DELETE FROM leases WHERE expires < ?', (now,))
+            connection.execute('DELETE FROM workers WHERE heartbeat < ?', (now - 100 * self.heartbeat_interval,))
+        self.database.transaction(expire_rows)
+
+    def __lease(self, name, now, expires):
+        # Take or renew a lease if it is free, expired or already ours
+        def lease(connection):
+            rows = connection.execute('SELECT worker, expires FROM leases WHERE name = ?', (name,)).fetchall()
+            if rows and rows[0][0] != self.worker and rows[0][1] >= now:
+                return False
+            connection.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)', (name, self.worker, expires))
+            return True
+        return self.database.transaction(lease)
+
+    def __beat_forever(self):
+        while True:
+            self.__stopping.wait(self.heartbeat_interval)
+            if self.__stopping.isSet():
+                return
+            try:
+                self.heartbeat()
+            except sqlite3.Error, e:
+                print('ERROR: cluster heartbeat: %s' % str(e))
+
+class SharedLinkStore:
+    """
+    A set of links that have already been processed, like a
+    linkstore.LinkStore, kept in a Coordinator's database so every
+    worker knows about the links the others have processed. Each is
+    stored by its key, the reddit fullname or the href of a link
+    migrated from an older store.
+    """
+
+    def __init__(self, coordinator, max_age=None):
+        self.database = coordinator.database
+        self.max_age = max_age
+
+    def __contains__(self, key):
+        rows = self.database.execute('SELECT processed_at FROM processed WHERE key = ?', key)
+        if not rows:
+            return False
+        if self.max_age and rows[0][0] < time.time() - self.max_age:
+            return False
+        return True
+
+    def __len__(self):
+        return self.database.execute('SELECT COUNT(*) FROM processed')[0][0]
+
+    def __iter__(self):
+        return iter([key for key, in self.database.execute('SELECT key FROM processed')])
+
+    def add(self, key, processed_at=None):
+        """
+        Mark a link as processed by its key.
+        """
+        if processed_at is None:
+            processed_at = time.time()
+        self.database.change('INSERT OR REPLACE INTO processed VALUES (?, ?)', key, processed_at)
+
+    def migrate(self, keys):
+        """
+        Import the hrefs of links from an older store as keys, returns the number imported.
+        """
+        now = time.time()
+        rows = [(key, now) for key in keys]
+        def insert(connection):
+            return connection.executemany('INSERT OR IGNORE INTO processed VALUES (?, ?)', rows).rowcount
+        return self.database.transaction(insert)
+
+    def expire(self, now=None):
+        """
+        Forget links older than max_age, returns the number dropped.
+        """
+        if not self.max_age:
+            return 0
+        if now is None:
+            now = time.time()
+        return self.database.change('DELETE FROM processed WHERE processed_at < ?', now - self.max_age)
+
+    def close(self):
+        pass
+
+if __name__ == '__main__':
+    # Show how links are split between three workers and move when one leaves
+    import tempfile
+    filename = os.path.join(tempfile.mkdtemp(prefix='cluster'), 'cluster.db')
+    workers = [Coordinator(filename, name) for name in ('alpha', 'beta', 'gamma')]
+    for worker in workers:
+        worker.heartbeat()
+    for worker in workers:
+        worker.heartbeat()
+
+    links = [reddit.RedditLink('Post %d' % (number), 'http://example.craigslist.org/%d.html' % (number), 'test',
+                               'example.craigslist.org', str(number), 't3_%d' % (number)) for number in range(30)]
+    workers[0].offer(links)
+    for worker in workers:
+        taken = worker.take()
+        for link in taken:
+            worker.release(link)
+        print("%s owns %d links, poster: %s" % (worker.worker, len(taken), worker.is_poster()))
+
+    # Once beta leaves the others share its links between them
+    workers[1].stop()
+    for worker in (workers[0], workers[2]):
+        worker.heartbeat()
+        print("%s owns %d links" % (worker.worker, len(worker.take())))
@@ -20,8 +20,10 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
 
-import os.path
+import os
 import urllib2
+import transport
+import asynchttp
 
 try:
     import json
@@ -29,53 +31,124 @@ except:
     print("Failed to load json, requires Python 2.6 or later")
     sys.exit(1)
 
+UPLOAD_URL = 'http://imgur.com/api/upload.json'
+
+def _upload_body(apikey, data, extension):
+    # Returns the pieces of a multipart upload request body and its content type
+    boundary = '----------boundary'
+    head = '--' + boundary + '\r\n'
+    head += 'Content-Disposition: form-data; name="key"\r\n'
+    head += '\r\n'
+    head += str(apikey) + '\r\n'
+
+    head += '--' + boundary + '\r\n'
+    head += 'Content-Disposition: form-data; name="image"; filename="ric'
+    head += extension
+    head += '"\r\n'
+    head += 'Content-Type: application/octet-stream\r\n'
+    head += '\r\n'
+
+    tail = '\r\n'
+    tail += '--' + boundary + '--\r\n'
+    tail += '\r\n'
+
+    content_type = 'multipart/form-data; boundary=%s' % boundary
+    return [head, data, tail], content_type
+
+def _upload_result(http, contents):
+    # Returns the viewing url from imgur's json response to an upload
+    try:
+        result = json.loads(contents)
+    except ValueError:
+        raise RuntimeError('Failed to upload image to imgur.com, HTTP error %d: %s' % (http.code, http.msg))
+
+    if result['rsp']['stat'] != 'ok':
+        raise RuntimeError('Failed to upload image to imgur.com, error %d: %s' % (result['rsp']['error_code'], result['rsp']['error_msg']))
+    
+    return result['rsp']['image']['imgur_page']
+
 class ImgurApi:
     """
     A class for using the imgur.com api
     See http://code.google.com/p/imgur-api
     """
-    def __init__(self, apikey):
+    def __init__(self, apikey, http_transport=None):
+        """
+        Pass the api key and optionally a transport.HttpTransport to share
+        connections with other apis.
+        """
         self._apikey = apikey
+        if http_transport is None:
+            http_transport = transport.HttpTransport()
+        self.transport = http_transport
 
     def upload_image(self, filename):
         """
         Upload an image to imgur and return the viewing url.
         """
+        with open(filename, 'rb') as handle:
+            return self.upload_data(handle, os.path.splitext(filename)[1])
 
-        boundary = '----------boundary'
-        body = '--' + boundary + '\r\n'
-        body += 'Content-Disposition: form-data; name="key"\r\n'
-        body += '\r\n'
-        body += self._apikey + '\r\n'
-
-        body += '--' + boundary + '\r\n'
-        body += 'Content-Disposition: form-data; name="image"; filename="ric'
-        body += os.path.splitext(filename)[1]
-        body += '"\r\n'
-        body += 'Content-Type: application/octet-stream\r\n'
-        body += '\r\n'
-
-        handle = open(filename, 'r')
-        body += handle.read() + '\r\n'
-        handle.close()
-
-        body += '--' + boundary + '--\r\n'
-        body += '\r\n'
-
-        content_type = 'multipart/form-data; boundary=%s' % boundary
-
-        # TODO: Switch to urllib2
-        request = urllib2.Request('http://imgur.com/api/upload.json', body, { 'content-type': content_type, 'content-length': str(len(body)) })
-        http = urllib2.urlopen(request)
-        contents = http.read()
-        http.close()
-        result = json.loads(contents)
+    def upload_data(self, data, extension='.png'):
+        """
+        Upload an image held in memory to imgur and return the viewing url.
+        Pass the image either as a string of bytes or a file-like object,
+        along with the file extension for its format.
+        The request body is sent in pieces so the image is never copied into
+        one big string.
+        """
+        pieces, content_type = _upload_body(self._apikey, data, extension)
+
+        # A failed upload still comes back with a json description of the error
+        try:
+            http = self.transport.request('POST', UPLOAD_URL, pieces, { 'Content-Type': content_type })
+            contents = http.read()
+        except urllib2.HTTPError, e:
+            contents = e.read()
+            http = e
+        return _upload_result(http, contents)
+
+class AsyncImgurApi:
+    """
+    The imgur.com api for use with asynchttp, so many uploads can be in
+    progress at once on one event loop. Methods return asynchttp.Task
+    results instead of waiting for imgur.
+    """
+    def __init__(self, apikey, client=None):
+        """
+        Pass the api key and optionally an asynchttp.AsyncHttpClient to share
+        its event loop with other apis.
+        """
+        self._apikey = apikey
+        if client is None:
+            client = asynchttp.AsyncHttpClient()
+        self.client = client
+
+    def upload_image(self, filename):
+        """
+        Upload an image to imgur, the task's value is the viewing url.
+        """
+        handle = open(filename, 'rb')
+        task = self.upload_data(handle, os.path.splitext(filename)[1])
+        task.add_callback(lambda value, error: handle.close())
+        return task
+
+    def upload_data(self, data, extension='.png'):
+        """
+        Upload an image held in memory to imgur, the task's value is the viewing url.
+        """
+        return self.client.spawn(self.__upload_data(data, extension))
+
+    def __upload_data(self, data, extension):
+        pieces, content_type = _upload_body(self._apikey, data, extension)
+        try:
+            http = yield self.client.request('POST', UPLOAD_URL, pieces, { 'Content-Type': content_type })
+            contents = http.read()
+        except urllib2.HTTPError, e:
+            contents = e.read()
+            http = e
+        yield asynchttp.Return(_upload_result(http, contents))
 
-        if result['rsp']['stat'] != 'ok':
-            raise RuntimeError('Failed to upload image to imgur.com, error %d: %s' % (result['rsp']['error_code'], result['rsp']['error_msg']))
-        
-        return result['rsp']['image']['imgur_page']
-        
 if __name__ == '__main__':
     # Test the class
     key = raw_input("Enter your Imgur key:")
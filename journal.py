@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+#
+# journal.py
+# A durable record of how far each link has got through the pipeline so
+# work survives a restart and failing links are retried with backoff
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import sys
+import time
+import threading
+import scheduler
+import atomicfile
+
+try:
+    import json
+except:
+    print("Failed to load json, requires Python 2.6 or later")
+    sys.exit(1)
+
+# The stages a link completes in order, a job's stage is the last it completed
+STAGES = ('discovered', 'rendered', 'uploaded', 'commented')
+
+# What a job is doing: in the pipeline, waiting to be retried or given up on
+ACTIVE, WAITING, DEAD = 'active', 'waiting', 'dead'
+
+# The RedditLink attributes kept so a job can be resumed without searching again
+LINK_FIELDS = ('title', 'href', 'subreddit', 'domain', 'name', 'fullname')
+
+class Job:
+    """
+    One link's progress: the last stage it completed, the artifacts made so
+    far (screenshot files and the imgur link) and its retry state.
+    """
+
+    def __init__(self, link=None, fields=None):
+        if fields is None:
+            fields = { 'link': dict([(name, getattr(link, name)) for name in LINK_FIELDS]),
+                       'stage': 'discovered', 'state': ACTIVE, 'attempts': 0, 'retry_at': 0,
+                       'error': None, 'images': [], 'extension': None, 'imgur_link': None,
+                       'updated': time.time() }
+        self.fields = fields
+        self.image_data = None # Screenshots kept in memory when the journal has no directory for them
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['fields'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def fullname(self):
+        return self.fields['link']['fullname']
+
+class Journal:
+    """
+    Remembers the stage each link in the pipeline has reached, in an
+    append-only log of JSON records like the LinkStore, so after a restart
+    each link carries on from the stage it last completed. Screenshots are
+    saved in image_directory once rendered until they are uploaded.
+    Links that fail are retried after an exponential backoff, and after
+    max_attempts failures are kept as dead so they aren't tried again.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self, filename=None, image_directory=None, max_attempts=5, retry_base=60, retry_maximum=6 * 60 * 60,
+                 max_age=None, compact_minimum=1000):
+        """
+        Open (or create) the journal in filename, or pass None to keep it in
+        memory only. Dead jobs older than max_age seconds are forgotten.
+        """
+        self.filename = filename
+        self.image_directory = image_directory
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_maximum = retry_maximum
+        self.max_age = max_age
+        self.compact_minimum = compact_minimum
+
+        self.__jobs = {} # fullname -> Job
+        self.__log = None
+        self.__log_records = 0
+        self.__lock = threading.Lock()
+
+        if self.image_directory and not os.path.isdir(self.image_directory):
+            os.makedirs(self.image_directory)
+        if self.filename:
+            self.__load()
+            self.__log = open(self.filename, 'ab')
+
+        # Jobs that were in the pipeline when we stopped carry on straight away
+        for job in self.__jobs.values():
+            if job.state == ACTIVE:
+                job.fields['state'] = WAITING
+                job.fields['retry_at'] = 0
+
+    def __contains__(self, fullname):
+        return fullname in self.__jobs
+
+    def __len__(self):
+        return len(self.__jobs)
+
+    def get(self, fullname):
+        """
+        Returns the Job for a link's fullname, or None.
+        """
+        return self.__jobs.get(fullname)
+
+    def discovered(self, link):
+        """
+        Start a job for a newly found RedditLink. Returns the new Job, or
+        None if the link already has one (in progress, waiting or dead).
+        """
+        with self.__lock:
+            if link.fullname in self.__jobs:
+                return None
+            job = Job(link)
+            self.__jobs[link.fullname] = job
+            self.__append(job)
+            return job
+
+    def rendered(self, link, image, extension):
+        """
+        Record a link's screenshot (data or a list of tiles) and keep it until it is uploaded.
+        """
+        with self.__lock:
+            job = self.__jobs.get(link.fullname)
+            if job is None:
+                return
+            tiles = isinstance(image, list) and image or [image]
+            if self.image_directory:
+                filenames = []
+                for index, tile in enumerate(tiles):
+                    filename = os.path.join(self.image_directory, '%s-%d%s' % (link.fullname, index, extension))
+                    with open(filename, 'wb') as image_file:
+                        image_file.write(tile)
+                        image_file.flush()
+                        os.fsync(image_file.fileno())
+                    filenames += [filename]
+                job.fields['images'] = filenames
+            else:
+                job.image_data = tiles
+            job.fields['extension'] = extension
+            self.__advance(job, 'rendered')
+
+    def uploaded(self, link, imgur_link):
+        """
+        Record the imgur link a link's screenshot was uploaded to, the screenshot is no longer kept.
+        """
+        with self.__lock:
+            job = self.__jobs.get(link.fullname)
+            if job is None:
+                return
+            self.__remove_images(job)
+            job.fields['imgur_link'] = imgur_link
+            self.__advance(job, 'uploaded')
+
+    def commented(self, link):
+        """
+        Record that a link is finished, it is dropped from the journal.
+        """
+        self.forget(link)
+
+    def forget(self, link):
+        """
+        Drop a link's job whatever stage it has reached, such as one which
+        was finished by an earlier version or whose site is no longer watched.
+        """
+        with self.__lock:
+            job = self.__jobs.pop(link.fullname, None)
+            if job is None:
+                return
+            self.__remove_images(job)
+            job.fields['stage'] = 'commented'
+            self.__append(job)
+
+    def failed(self, link, error):
+        """
+        Record a failure. The job will be due again after a backoff which
+        grows with each attempt, or is dead after max_attempts.
+        Returns the Job.
+        """
+        with self.__lock:
+            job = self.__jobs.get(link.fullname)
+            if job is None:
+                return None
+            job.fields['attempts'] += 1
+            job.fields['error'] = str(error)
+            if job.attempts >= self.max_attempts:
+                job.fields['state'] = DEAD
+                self.__remove_images(job)
+            else:
+                backoff = scheduler.Backoff(self.retry_base, self.retry_maximum)
+                backoff.failures = job.attempts - 1
+                job.fields['state'] = WAITING
+                job.fields['retry_at'] = time.time() + backoff.failed(scheduler.throttle_delay(error) or 0)
+            job.fields['updated'] = time.time()
+            self.__append(job)
+            return job
+
+    def due(self, now=None):
+        """
+        Returns the waiting jobs whose retry time has come, marking them
+        active again. Resume each from the stage it last completed.
+        """
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            due = [job for job in self.__jobs.values() if job.state == WAITING and job.retry_at <= now]
+            for job in due:
+                job.fields['state'] = ACTIVE
+            return due
+
+    def uploaded_jobs(self):
+        """
+        Returns the active jobs which have been uploaded and are waiting
+        for their comment, the longest waiting first.
+        """
+        with self.__lock:
+            jobs = [job for job in self.__jobs.values() if job.state == ACTIVE and job.stage == 'uploaded']
+        jobs.sort(key=lambda job: job.updated)
+        return jobs
+
+    def dead(self):
+        """
+        Returns the jobs that have been given up on.
+        """
+        with self.__lock:
+            return [job for job in self.__jobs.values() if job.state == DEAD]
+
+    def counts(self):
+        """
+        Returns the number of jobs in each state.
+        """
+        counts = { ACTIVE: 0, WAITING: 0, DEAD: 0 }
+        with self.__lock:
+            for job in self.__jobs.values():
+                counts[job.state] += 1
+        return counts
+
+    def image(self, job):
+        """
+        Returns a rendered job's screenshot, as data or a list of tiles, or None if it has been lost.
+        """
+        tiles = job.image_data
+        if tiles is None and job.images:
+            try:
+                tiles = []
+                for filename in job.images:
+                    with open(filename, 'rb') as image_file:
+                        tiles += [image_file.read()]
+            except IOError:
+                return None
+        if not tiles:
+            return None
+        return len(tiles) == 1 and tiles[0] or tiles
+
+    def expire(self, now=None):
+        """
+        Forget dead jobs older than max_age and compact the log if worthwhile.
+        """
+        with self.__lock:
+            if self.max_age:
+                if now is None:
+                    now = time.time()
+                for fullname, job in self.__jobs.items():
+                    if job.state == DEAD and job.updated < now - self.max_age:
+                        del self.__jobs[fullname]
+            if self.__log_records > max(self.compact_minimum, 2 * len(self.__jobs)):
+                self.__compact()
+
+    def close(self):
+        """
+        Close the log file.
+        """
+        with self.__lock:
+            if self.__log:
+                self.__log.close()
+                self.__log = None
+
+    def __advance(self, job, stage):
+        job.fields['stage'] = stage
+        job.fields['updated'] = time.time()
+        self.__append(job)
+
+    def __remove_images(self, job):
+        for filename in job.images:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        job.fields['images'] = []
+        job.image_data = None
+
+    def __load(self):
+        # A crash during a write can leave a partial last line, cut it off
+        # so the next record appended starts on a line of its own
+        atomicfile.trim_partial_line(self.filename)
+        try:
+            log = open(self.filename, 'rb')
+        except IOError:
+            return
+
+        with log:
+            for line in log:
+                try:
+                    fields = json.loads(line)
+                except ValueError:
+                    continue
+                fullname = fields['link']['fullname']
+                if fields['stage'] == 'commented':
+                    self.__jobs.pop(fullname, None)
+                else:
+                    self.__jobs[fullname] = Job(fields=fields)
+                self.__log_records += 1
+
+    def __append(self, job):
+        self.__log_records += 1
+        if not self.__log:
+            return
+        self.__log.write(json.dumps(job.fields) + '\n')
+        self.__log.flush()
+        os.fsync(self.__log.fileno())
+
+    def __compact(self):
+        # Rewrite the log with only the live jobs, renaming it over the old one
+        if not self.filename:
+            return
+        self.__log.close()
+        try:
+            atomicfile.write(self.filename, lambda log: log.writelines([json.dumps(job.fields) + '\n'
+                                                                        for job in self.__jobs.itervalues()]))
+        finally:
+            self.__log = open(self.filename, 'ab')
+        self.__log_records = len(self.__jobs)
+
+if __name__ == '__main__':
+    # Test the class by failing a link until it is dead
+    import tempfile
+    import reddit
+    directory = tempfile.mkdtemp(prefix='journal')
+    filename = os.path.join(directory, 'journal.log')
+
+    link = reddit.RedditLink('Test', 'http://example.craigslist.org/1.html', 'test', 'example.craigslist.org', '1', 't3_1')
+    journal = Journal(filename, directory, max_attempts=3, retry_base=1)
+    journal.discovered(link)
+    journal.rendered(link, 'PNG DATA', '.png')
+    journal.failed(link, RuntimeError('upload failed'))
+    journal.close()
+
+    journal = Journal(filename, directory, max_attempts=3, retry_base=1)
+    job = journal.get('t3_1')
+    print("Reloaded job at stage %s with %d attempt, image %r" % (job.stage, job.attempts, journal.image(job)))
+    for i in range(2):
+        journal.failed(link, RuntimeError('upload failed again'))
+    print("After 3 failures the job is %s" % (journal.get('t3_1').state))
+    journal.close()
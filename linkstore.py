@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# linkstore.py
+# Remember which links have already been processed using an in-memory set
+# backed by an append-only log file
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import sys
+import time
+import atomicfile
+
+try:
+    import json
+except:
+    print("Failed to load json, requires Python 2.6 or later")
+    sys.exit(1)
+
+class LinkStore:
+    """
+    A set of links that have already been processed, each stored by a key:
+    the link's reddit fullname, or for links saved by older versions (and
+    migrated from ~/.ric.pkl) the href of the page it linked to.
+    Lookups are done against an in-memory dictionary and every new link is
+    appended to a log file on disk, one JSON record per line, so saving a
+    link never rewrites the whole file. The log is compacted when it grows
+    well beyond the number of live links.
+    """
+
+    def __init__(self, filename=None, max_age=None, compact_ratio=2, compact_minimum=1000):
+        """
+        Open (or create) the store in filename, or pass None to keep it in memory only.
+        If max_age is given, links processed more than max_age seconds ago are forgotten.
+        The log is compacted when it has more than compact_ratio times as many
+        records as there are live links (and at least compact_minimum records).
+        """
+        self.filename = filename
+        self.max_age = max_age
+        self.compact_ratio = compact_ratio
+        self.compact_minimum = compact_minimum
+
+        self.__links = {} # key -> time it was processed
+        self.__log = None
+        self.__log_records = 0
+
+        if self.filename:
+            self.__load()
+            self.__log = open(self.filename, 'ab')
+        self.expire()
+
+    def __contains__(self, key):
+        processed_at = self.__links.get(key)
+        if processed_at is None:
+            return False
+        if self.max_age and processed_at < time.time() - self.max_age:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.__links)
+
+    def __iter__(self):
+        return iter(self.__links)
+
+    def add(self, key, processed_at=None):
+        """
+        Mark a link as processed by its key and write it to the log straight away.
+        """
+        if processed_at is None:
+            processed_at = time.time()
+        self.__links[key] = processed_at
+        self.__append([(key, processed_at)])
+
+    def migrate(self, keys):
+        """
+        Import the hrefs of links from an older store (such as the list
+        pickled in ~/.ric.pkl) as keys. Links we already know about are
+        left alone. Returns the number imported.
+        """
+        now = time.time()
+        records = []
+        for key in keys:
+            if key not in self.__links:
+                self.__links[key] = now
+                records += [(key, now)]
+        self.__append(records)
+        return len(records)
+
+    def expire(self, now=None):
+        """
+        Forget links older than max_age and compact the log if worthwhile.
+        Returns the number of links that were dropped.
+        """
+        expired = 0
+        if self.max_age:
+            if now is None:
+                now = time.time()
+            cutoff = now - self.max_age
+            for key, processed_at in self.__links.items():
+                if processed_at < cutoff:
+                    del self.__links[key]
+                    expired += 1
+
+        if self.__log_records > max(self.compact_minimum, self.compact_ratio * len(self.__links)):
+            self.compact()
+        return expired
+
+    def compact(self):
+        """
+        Rewrite the log so it only contains the live links.
+        The new log is written to a temporary file and renamed over the old one
+        so a crash part way through leaves the previous log intact.
+        """
+        if not self.filename:
+            return
+
+        self.__log.close()
+        try:
+            atomicfile.write(self.filename, lambda log: log.writelines([self.__record(key, processed_at)
+                                                                        for key, processed_at in self.__links.iteritems()]))
+        finally:
+            self.__log = open(self.filename, 'ab')
+        self.__log_records = len(self.__links)
+
+    def close(self):
+        """
+        Close the log file.
+        """
+        if self.__log:
+            self.__log.close()
+            self.__log = None
+
+    def __load(self):
+        # A crash during a write can leave a partial last line, cut it off
+        # so the next record appended starts on a line of its own
+        atomicfile.trim_partial_line(self.filename)
+        try:
+            log = open(self.filename, 'rb')
+        except IOError:
+            return
+
+        with log:
+            for line in log:
+                try:
+                    key, processed_at = json.loads(line)
+                except ValueError:
+                    continue
+                self.__links[key] = processed_at
+                self.__log_records += 1
+
+    def __append(self, records):
+        self.__log_records += len(records)
+        if not self.__log or not records:
+            return
+
+        self.__log.write(''.join([self.__record(key, processed_at) for key, processed_at in records]))
+        self.__log.flush()
+        os.fsync(self.__log.fileno())
+
+    def __record(self, key, processed_at):
+        return json.dumps([key, processed_at]) + '\n'
+
+if __name__ == '__main__':
+    # Test the class
+    import tempfile
+    filehandle, filename = tempfile.mkstemp(prefix='linkstore', suffix='.log')
+    os.close(filehandle)
+
+    store = LinkStore(filename, compact_minimum=2)
+    store.migrate(['http://example.craigslist.org/1', 'http://example.craigslist.org/2'])
+    store.add('http://example.craigslist.org/3')
+    store.add('http://example.craigslist.org/3')
+    store.close()
+
+    store = LinkStore(filename, compact_minimum=2)
+    print("Loaded %d links (expecting 3):" % (len(store)))
+    print(sorted(store))
+    print("Old link stored: %s" % ('http://example.craigslist.org/1' in store))
+    print("New link stored: %s" % ('http://example.craigslist.org/4' in store))
+    store.close()
+    os.unlink(filename)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+#
+# metrics.py
+# Counters, gauges and timing histograms for watching ric while it runs,
+# served as Prometheus text, logged as json lines or profiled on demand
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import sys
+import time
+import bisect
+import cProfile
+import tempfile
+import threading
+import BaseHTTPServer
+
+try:
+    import json
+except:
+    print("Failed to load json, requires Python 2.6 or later")
+    sys.exit(1)
+
+# Histogram bucket upper bounds in seconds, from a quick request to a render
+# which runs into renderpool's timeout and is killed as hung
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+def process_memory(pid=None):
+    """
+    Returns the resident memory in bytes of a process (this one by default),
+    or None if it can't be found out, for example when not on Linux.
+    """
+    if pid is None:
+        pid = os.getpid()
+    try:
+        with open('/proc/%d/statm' % (pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def _format_labels(labels, extra=()):
+    # Returns labels as {name="value",...} for Prometheus, or '' if there are none
+    pairs = sorted(labels.items()) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(['%s="%s"' % (name, value) for name, value in escaped]) + '}'
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+class Counter:
+    """
+    A count that only goes up, such as the number of links processed.
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, (), self.value)]
+
+    def summary(self):
+        return self.value
+
+class Gauge:
+    """
+    A value that goes up and down, such as a queue's length. Either set()
+    it, or pass a function which is called for the value when it is read.
+    """
+
+    def __init__(self, name, labels, function=None):
+        self.name = name
+        self.labels = labels
+        self.function = function
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception:
+            return None
+
+    def samples(self):
+        return [(self.name, self.labels, (), self.get())]
+
+    def summary(self):
+        return self.get()
+
+class Histogram:
+    """
+    Counts how many observations, such as how long renders take, fall into
+    each of a fixed set of buckets so percentiles can be estimated cheaply.
+    """
+
+    def __init__(self, name, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # The last is for values above every bucket
+        self.count = 0
+        self.sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value):
+        with self.__lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction of
+        observations, so quantile(0.95) is at least the p95 value.
+        """
+        with self.__lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                break
+        if index == len(self.buckets):
+            return float('inf')
+        return self.buckets[index]
+
+    def samples(self):
+        with self.__lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            samples += [(self.name + '_bucket', self.labels, [('le', _format_value(bucket))], cumulative)]
+        samples += [(self.name + '_sum', self.labels, (), total),
+                    (self.name + '_count', self.labels, (), count)]
+        return samples
+
+    def summary(self):
+        # Values above the last bucket have no upper bound, which json can't hold
+        summary = { 'count': self.count, 'sum': self.sum }
+        for name, fraction in (('p50', 0.5), ('p95', 0.95)):
+            value = self.quantile(fraction)
+            if value == float('inf'):
+                value = None
+            summary[name] = value
+        return summary
+
+class Registry:
+    """
+    Holds every metric so they can all be read at once by the sinks.
+    Asking for a metric that already exists with the same labels returns it.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self):
+        self.__families = [] # (name, type, help), in the order they were added
+        self.__metrics = {} # name -> list of metrics with different labels
+        self.__lock = threading.Lock()
+
+    def counter(self, name, help, **labels):
+        return self.__get(Counter, 'counter', name, help, labels)
+
+    def gauge(self, name, help, function=None, **labels):
+        gauge = self.__get(Gauge, 'gauge', name, help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, **labels):
+        return self.__get(Histogram, 'histogram', name, help, labels, buckets)
+
+    def prometheus_text(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, kind, help, metrics in self.__collect():
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+            for metric in metrics:
+                for sample_name, labels, extra, value in metric.samples():
+                    lines += ['%s%s %s' % (sample_name, _format_labels(labels, extra), _format_value(value))]
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Returns every metric as a dictionary from name and labels to value,
+        with count, sum and estimated percentiles for histograms.
+        """
+        values = {}
+        for name, kind, help, metrics in self.__collect():
+            for metric in metrics:
+                values[name + _format_labels(metric.labels)] = metric.summary()
+        return values
+
+    def __get(self, metric_class, kind, name, help, labels, *args):
+        with self.__lock:
+            metrics = self.__metrics.get(name)
+            if metrics is None:
+                metrics = self.__metrics[name] = []
+                self.__families += [(name, kind, help)]
+            for metric in metrics:
+                if metric.labels == labels:
+                    if not isinstance(metric, metric_class):
+                        raise ValueError('Metric %s is already a %s' % (name, metric.__class__.__name__))
+                    return metric
+            metric = metric_class(name, labels, *args)
+            metrics += [metric]
+            return metric
+
+    def __collect(self):
+        with self.__lock:
+            return [(name, kind, help, list(self.__metrics[name])) for name, kind, help in self.__families]
+
+class Profiler:
+    """
+    Profiles one item of each stage of the pipeline with cProfile when
+    asked, writing the stats to a file for each stage which can be read
+    with the pstats module.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = tempfile.gettempdir()
+        self.directory = directory
+        self.__wanted = set()
+        self.__lock = threading.Lock()
+
+    def request(self, stages):
+        """
+        Profile the next item handled by each of the given stages.
+        """
+        with self.__lock:
+            self.__wanted.update(stages)
+
+    def run(self, stage, function, *args, **kwargs):
+        """
+        Call function, profiling it if a profile of the stage was requested.
+        """
+        with self.__lock:
+            wanted = stage in self.__wanted
+            self.__wanted.discard(stage)
+        if not wanted:
+            return function(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            filename = os.path.join(self.directory, 'ric-%s-%s.prof' % (stage, time.strftime('%Y%m%d-%H%M%S')))
+            profile.dump_stats(filename)
+            print("> Saved profile of %s to %s" % (stage, filename))
+
+class MetricsServer:
+    """
+    Serves the metrics in Prometheus text format at /metrics on a local
+    port from a background thread. If a Profiler is given, requesting
+    /profile profiles the next item of every stage.
+    """
+
+    def __init__(self, registry, port=9464, host='127.0.0.1', profiler=None, stages=()):
+        self.registry = registry
+        self.profiler = profiler
+        self.stages = stages
+
+        server = self
+        class Handler(_MetricsHandler):
+            metrics_server = server
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    metrics_server = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            self.reply(self.metrics_server.registry.prometheus_text(), 'text/plain; version=0.0.4')
+        elif path == '/profile' and self.metrics_server.profiler:
+            self.metrics_server.profiler.request(self.metrics_server.stages)
+            self.reply('Profiling the next item of each stage, the stats will be saved in %s\n' % (self.metrics_server.profiler.directory))
+        else:
+            self.send_error(404)
+
+    def reply(self, body, content_type='text/plain'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class JsonLogger:
+    """
+    Writes a snapshot of the metrics as one line of json every interval
+    seconds from a background thread.
+    """
+
+    def __init__(self, registry, interval=60, stream=None):
+        if stream is None:
+            stream = sys.stdout
+        self.registry = registry
+        self.interval = interval
+        self.stream = stream
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__log_forever)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop logging, writing one last line so the final values are recorded.
+        """
+        self.__stopping.set()
+        while self.__thread.isAlive():
+            self.__thread.join(0.5)
+        self.log()
+
+    def log(self):
+        line = json.dumps({ 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'metrics': self.registry.snapshot() }, sort_keys=True)
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def __log_forever(self):
+        while True:
+            self.__stopping.wait(self.interval)
+            if self.__stopping.isSet():
+                return
+            self.log()
+
+if __name__ == '__main__':
+    # Show what some metrics look like
+    registry = Registry()
+    renders = registry.histogram('ric_stage_seconds', 'Time taken by each stage', stage='render')
+    for seconds in (0.3, 1.2, 2.0, 4.5, 40):
+        renders.observe(seconds)
+    registry.counter('ric_links_total', 'Links by outcome', outcome='processed').inc(5)
+    registry.gauge('ric_memory_bytes', 'Resident memory of this process', process_memory)
+    print(registry.prometheus_text())
+    JsonLogger(registry).log()
@@ -0,0 +1,715 @@
+#!/usr/bin/env python
+#
+# pipeline.py
+# Staged pipeline for finding links on reddit, rendering them, uploading the
+# screenshots to imgur and posting the imgur links back to reddit
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import math
+import time
+import Queue
+import reddit
+import journal
+import scheduler
+import metrics
+import threading
+import collections
+import uploadcache
+
+# The stages every link passes through, in order
+STAGES = ('search', 'preflight', 'render', 'upload', 'comment')
+
+def _job_link(job):
+    return reddit.RedditLink(*[job.link[name] for name in journal.LINK_FIELDS])
+
+class StageCounter:
+    """
+    Thread-safe throughput counters for one stage of the pipeline.
+    """
+
+    def __init__(self, name, samples=10000, registry=None):
+        """
+        The times of the last samples successful items are kept for percentiles.
+        Pass a metrics.Registry to also record the stage's times there.
+        """
+        self.name = name
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.size = 0
+        self.started = time.time()
+        self.__durations = collections.deque(maxlen=samples)
+        self.__lock = threading.Lock()
+
+        self.__histogram = None
+        if registry is not None:
+            self.__histogram = registry.histogram('ric_stage_seconds', 'Seconds taken by each item in each stage', stage=name)
+            self.__outcomes = { True: registry.counter('ric_stage_items_total', 'Items handled by each stage', stage=name, result='ok'),
+                                False: registry.counter('ric_stage_items_total', 'Items handled by each stage', stage=name, result='failed') }
+
+    def record(self, seconds, succeeded=True, size=0):
+        """
+        Record one item passing through the stage, how long it took and
+        optionally how many bytes it produced.
+        """
+        with self.__lock:
+            if succeeded:
+                self.completed += 1
+                self.__durations.append(seconds)
+            else:
+                self.failed += 1
+            self.busy_seconds += seconds
+            self.size += size
+        if self.__histogram is not None:
+            self.__histogram.observe(seconds)
+            self.__outcomes[succeeded].inc()
+
+    def per_minute(self):
+        """
+        Returns the number of items completed per minute since the stage started.
+        """
+        elapsed = max(time.time() - self.started, 1)
+        return self.completed * 60.0 / elapsed
+
+    def percentile(self, fraction):
+        """
+        Returns the time taken by the given fraction of recent successful
+        items or less, so percentile(0.95) is the p95 latency.
+        """
+        with self.__lock:
+            durations = sorted(self.__durations)
+        if not durations:
+            return 0.0
+        return durations[max(0, int(math.ceil(fraction * len(durations))) - 1)]
+
+    def __str__(self):
+        handled = self.completed + self.failed
+        average = handled and self.busy_seconds / handled or 0
+        description = '%s: %d done, %d failed, %.2f/min, %.1fs average' % (self.name, self.completed, self.failed, self.per_minute(), average)
+        if self.size:
+            description += ', %.1fKB average' % (self.size / 1024.0 / max(self.completed, 1))
+        return description
+
+class Pipeline:
+    """
+    Finds links on reddit and passes them through the stages:
+        discovery -> preflight -> render -> upload -> comment
+    Each stage is connected to the next by a bounded queue so a slow stage
+    holds back the ones before it rather than letting work pile up, apart
+    from the comments, which wait in the journal so the comment interval
+    doesn't hold back rendering and uploading a burst of links.
+    Rendering happens on the thread that calls run() because Qt must be used
+    from the thread that created the QApplication, plus extra threads if the
+    renderer is a pool of worker processes. The optional check that pages
+    are still there and the uploads use pools of threads, and comments are
+    posted by a single thread that waits comment_interval seconds between
+    posts to avoid reddit's flood limit, backing off further if reddit
+    says we are posting too much.
+    """
+
+    def __init__(self, reddit, imgur, renderer, processed, query, accept, links_from='day',
+                 dry_run=False, renderers=1, uploaders=2, queue_size=4, poll_schedule=None, comment_interval=660,
+                 image_options=None, upload_cache=None, accept_domain=None, registry=None, profiler=None,
+                 options_for=None, job_journal=None, preflight=None, checkers=2, coordinator=None, backfill=None):
+        """
+        Pass the reddit, imgur and webshot objects to use, a LinkStore of
+        links already processed, the reddit search query (or a list of queries
+        which are all searched each round) and a function that is passed each
+        RedditLink found and returns True if it should be cached.
+        In dry-run mode images are rendered but not uploaded or posted.
+        Only pass more than one renderer if the renderer can be used from
+        several threads at once, such as a renderpool.RendererPool.
+        Pass a webshot.ImageOptions to override the renderer's image options
+        and a scheduler.PollScheduler to change how often reddit is searched.
+        Pass an uploadcache.UploadCache to share imgur links between pipelines.
+        Pass accept_domain (see reddit.domain_matcher) to drop links from other
+        domains while the search results are parsed, before accept is called.
+        Pass a metrics.Registry to record timings, counts, queue depths and
+        renderer memory in, and a metrics.Profiler to profile stages on demand.
+        Pass options_for to choose the image options for each RedditLink's
+        page, for example watchlist.Watchlist.options_for, where it returns
+        None the pipeline's image options are used.
+        Pass a journal.Journal to record how far each link has got so links
+        carry on where they left off after a restart, failed links are
+        retried with backoff and given up on after too many failures.
+        Pass a preflight.PreflightChecker to check pages are still there
+        with checkers threads before they are rendered, removed pages are
+        never rendered and count as processed.
+        Pass a cluster.Coordinator to share the work with other workers, only
+        the links it hands this worker are processed and comments are queued
+        for whichever worker is the poster rather than posted here. processed
+        should then be the coordinator's cluster.SharedLinkStore.
+        Pass a backfill.Backfill to catch up on links posted while we were
+        not running, a page every backfill_interval seconds until it has
+        finished, then reddit is polled as usual.
+        """
+        self.reddit = reddit
+        self.imgur = imgur
+        self.renderer = renderer
+        self.processed = processed
+        if isinstance(query, basestring):
+            query = [query]
+        self.queries = list(query)
+        self.accept = accept
+        self.accept_domain = accept_domain
+        self.links_from = links_from
+        self.dry_run = dry_run
+        self.renderers = renderers
+        self.uploaders = uploaders
+        if poll_schedule is None:
+            poll_schedule = scheduler.PollScheduler()
+        self.poll_schedule = poll_schedule
+        self.comment_interval = comment_interval
+        self.comment_retries = 5
+        self.image_options = image_options
+        self.options_for = options_for
+        if upload_cache is None:
+            upload_cache = uploadcache.UploadCache()
+        self.upload_cache = upload_cache
+        if job_journal is None:
+            job_journal = journal.Journal()
+        self.journal = job_journal
+        self.preflight = preflight
+        self.checkers = checkers
+        self.coordinator = coordinator
+        self.backfill = backfill
+        self.backfill_interval = 2 # Reddit asks for no more than one request every two seconds
+
+        if registry is None:
+            registry = metrics.Registry()
+        self.registry = registry
+        if profiler is None:
+            profiler = metrics.Profiler()
+        self.profiler = profiler
+
+        self.counters = {}
+        for stage in STAGES:
+            self.counters[stage] = StageCounter(stage, registry=registry)
+        self.__render_phases = {}
+        for phase in ('load', 'paint', 'encode'):
+            self.__render_phases[phase] = registry.histogram('ric_render_phase_seconds', 'Seconds spent in each phase of rendering a page', phase=phase)
+        self.__outcomes = {}
+        for outcome in ('processed', 'gone', 'skipped', 'errored'):
+            self.__outcomes[outcome] = registry.counter('ric_links_total', 'Links found by outcome', outcome=outcome)
+
+        self.__preflight_queue = Queue.Queue(queue_size)
+        self.__render_queue = Queue.Queue(queue_size)
+        self.__upload_queue = Queue.Queue(queue_size)
+        registry.gauge('ric_queue_depth', 'Items waiting for each stage', self.__preflight_queue.qsize, queue='preflight')
+        registry.gauge('ric_queue_depth', 'Items waiting for each stage', self.__render_queue.qsize, queue='render')
+        registry.gauge('ric_queue_depth', 'Items waiting for each stage', self.__upload_queue.qsize, queue='upload')
+        registry.gauge('ric_queue_depth', 'Items waiting for each stage', lambda: len(self.__comments()), queue='comment')
+        registry.gauge('ric_renderer_memory_bytes', 'Resident memory of the processes running WebKit', self.__renderer_memory)
+        self.__stopping = threading.Event()
+        self.__discovery_thread = None
+        self.__preflight_threads = []
+        self.__render_threads = []
+        self.__upload_threads = []
+        self.__post_thread = None
+        self.__shared_post_thread = None
+        self.__cooldown = scheduler.Cooldown(comment_interval)
+
+        # Links (by reddit fullname) and pages (by canonical url) that are
+        # somewhere in the pipeline, so discovery doesn't queue them twice
+        self.__in_flight = set()
+        self.__in_flight_pages = set()
+        # Links waiting for another post of the same page to be uploaded, these
+        # are tried again on the next round of discovery
+        self.__deferred = []
+        self.__lock = threading.Lock()
+
+    def run(self):
+        """
+        Run the pipeline until stop() is called or Ctrl-C is pressed,
+        then finish any work already in progress and return.
+        """
+        self.__discovery_thread = self.__start_thread(self.__discover)
+        if self.preflight:
+            for i in range(self.checkers):
+                self.__preflight_threads += [self.__start_thread(self.__check)]
+        for i in range(self.renderers - 1):
+            self.__render_threads += [self.__start_thread(self.__render)]
+        if not self.dry_run:
+            for i in range(self.uploaders):
+                self.__upload_threads += [self.__start_thread(self.__upload)]
+            if not self.coordinator:
+                self.__post_thread = self.__start_thread(self.__post)
+            elif self.coordinator.poster:
+                self.__shared_post_thread = self.__start_thread(self.__post_shared)
+
+        try:
+            self.__render()
+        except KeyboardInterrupt:
+            print("> Finishing links in progress, press Ctrl-C again to quit immediately...")
+            self.stop()
+            self.__render()
+        self.__shutdown()
+
+    def stop(self):
+        """
+        Stop looking for new links. run() returns once the pipeline has drained.
+        """
+        self.__stopping.set()
+
+    def report(self):
+        """
+        Returns a string describing the throughput of each stage.
+        """
+        lines = [str(self.counters[stage]) for stage in STAGES if stage != 'preflight' or self.preflight]
+        lines += ['cache: %d hits, %d misses' % (self.upload_cache.hits, self.upload_cache.misses)]
+        counts = self.journal.counts()
+        lines += ['journal: %d comments waiting, %d waiting to retry, %d given up on' % (len(self.__comments()),
+                                                                                      counts[journal.WAITING], counts[journal.DEAD])]
+        if self.backfill:
+            lines += [str(self.backfill)]
+        if self.coordinator:
+            lines += ['cluster: %d workers, %d comments waiting for the poster' % (len(self.coordinator.workers()),
+                                                                                   self.coordinator.queued_comments())]
+        return '\n'.join(lines)
+
+    def __start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def __discover(self):
+        # Search reddit as often as the poll schedule says and queue any new links
+        # The cursors mean each search only returns links we haven't seen
+        cursors = [reddit.SearchCursor(query, self.links_from, accept_domain=self.accept_domain) for query in self.queries]
+        while not self.__stopping.isSet():
+            with self.__lock:
+                work = self.__deferred
+                self.__deferred = []
+
+            # Links that failed earlier, or were in progress when we last
+            # stopped, carry on from the stage they last completed
+            for job in self.journal.due():
+                link = _job_link(job)
+                if self.coordinator and not self.coordinator.claim(link):
+                    # Another worker took the link over while we were away
+                    self.journal.forget(link)
+                    continue
+                image = job.stage == 'rendered' and self.journal.image(job) or None
+                imgur_link = job.stage == 'uploaded' and job.imgur_link or None
+                work += [(link, imgur_link, image, job.extension, True)]
+
+            # While backfilling the cursors are only searched the first time
+            # so they know where to carry on from once the backfill is done
+            backfilling = self.backfill and not self.backfill.finished()
+            links = []
+            error = None
+            for cursor in cursors:
+                if backfilling and cursor.polls:
+                    continue
+                started = time.time()
+                try:
+                    links += self.profiler.run('search', self.reddit.search_new, cursor)
+                    self.counters['search'].record(time.time() - started)
+                except Exception, e:
+                    self.counters['search'].record(time.time() - started, False)
+                    print('ERROR: %s' % str(e))
+                    error = e
+
+            # Catch up on the links posted while we weren't running, a page a
+            # round as fast as reddit allows and the stages take them
+            if backfilling:
+                started = time.time()
+                try:
+                    links += self.profiler.run('search', self.backfill.next_links, self.reddit)
+                    self.counters['search'].record(time.time() - started)
+                except Exception, e:
+                    self.counters['search'].record(time.time() - started, False)
+                    print('ERROR: backfill: %s' % str(e))
+                    error = e
+
+            if error is None:
+                delay = self.poll_schedule.found(len(links))
+                if backfilling:
+                    delay = self.backfill_interval
+            else:
+                delay = self.poll_schedule.failed(error)
+
+            # Every worker's links are pooled and we get the ones we own
+            if self.coordinator:
+                self.coordinator.offer(links)
+                links = self.coordinator.take()
+
+            # Links with a job already are in progress, waiting to be retried or given up on
+            work += [(new_link, None, None, None, False) for new_link in links]
+            for item in work:
+                link, imgur_link, image, extension, resumed = item
+                if not self.accept(link):
+                    # The site is not, or no longer, watched
+                    self.journal.forget(link)
+                    self.__skipped(link, True)
+                    continue
+                if not resumed and link.fullname in self.journal:
+                    self.__skipped(link)
+                    continue
+
+                # Each reddit post gets a comment, but a page cross-posted or
+                # linked in different ways is only rendered and uploaded once
+                # Older versions stored the link's href in the processed store
+                page = uploadcache.canonical_url(link.href)
+                cached = False
+                if not imgur_link and image is None and not self.dry_run:
+                    imgur_link = self.upload_cache.get(page)
+                    cached = bool(imgur_link)
+                with self.__lock:
+                    if link.fullname in self.__in_flight:
+                        self.__outcomes['skipped'].inc()
+                        continue
+                    if link.fullname in self.processed or link.href in self.processed:
+                        self.journal.forget(link)
+                        self.__skipped(link, True)
+                        continue
+                    if not imgur_link:
+                        if page in self.__in_flight_pages:
+                            # Wait for the other post of this page to be uploaded
+                            self.__deferred += [item]
+                            continue
+                        self.__in_flight_pages.add(page)
+                    self.__in_flight.add(link.fullname)
+                self.journal.discovered(link)
+
+                if imgur_link:
+                    print("Using cached image for story\n    %s\n    %s\n    %s" % (link.title, link.comment_page(), imgur_link))
+                    # Only a job resumed at the uploaded stage has it journalled already
+                    if cached or not resumed:
+                        self.journal.uploaded(link, imgur_link)
+                    self.__comment(link, imgur_link)
+                    continue
+                if image is not None:
+                    queued = self.__put(self.__upload_queue, (link, image, extension), True)
+                elif self.preflight:
+                    queued = self.__put(self.__preflight_queue, link, True)
+                else:
+                    queued = self.__put(self.__render_queue, link, True)
+                if not queued:
+                    self.__finished(link)
+                    break
+            else:
+                # Every link found is in the journal now
+                if backfilling:
+                    self.backfill.checkpoint()
+                    if self.backfill.finished():
+                        print("> %s, polling for new links as usual" % (self.backfill))
+
+            with self.__lock:
+                self.processed.expire()
+            self.journal.expire()
+            if self.coordinator:
+                self.coordinator.expire()
+            self.__stopping.wait(delay)
+
+    def __check(self):
+        # Check pages are still there until discovery has stopped and the queue is empty
+        while True:
+            try:
+                link = self.__preflight_queue.get(True, 0.5)
+            except Queue.Empty:
+                if self.__drained(self.__preflight_queue, [self.__discovery_thread]):
+                    return
+                continue
+
+            started = time.time()
+            try:
+                gone = self.profiler.run('preflight', self.preflight.check, link.href)
+            except Exception, e:
+                self.counters['preflight'].record(time.time() - started, False)
+                self.__failed(link, e)
+                continue
+            self.counters['preflight'].record(time.time() - started)
+
+            # A removed page is done with, there is nothing worth rendering
+            if gone:
+                print("Page has been removed for story\n    %s\n    %s\n    %s" % (link.title, link.comment_page(), gone))
+                self.__finished(link, True, 'gone')
+            else:
+                self.__put(self.__render_queue, link)
+
+    def __render(self):
+        # Render links until discovery and the preflight checks have stopped and the queue is empty
+        while True:
+            try:
+                link = self.__render_queue.get(True, 0.5)
+            except Queue.Empty:
+                if self.__drained(self.__render_queue, [self.__discovery_thread] + self.__preflight_threads):
+                    return
+                continue
+
+            # Keep screenshots in memory unless we are only showing the files
+            options = self.options_for and self.options_for(link) or self.image_options
+            started = time.time()
+            try:
+                image, stats = self.profiler.run('render', self.renderer.render, link.href, as_data=not self.dry_run,
+                                                 options=options, with_stats=True)
+            except Exception, e:
+                self.counters['render'].record(time.time() - started, False)
+                self.__failed(link, e)
+                continue
+            self.counters['render'].record(time.time() - started, size=stats.get('encoded_bytes', 0))
+            for phase, histogram in self.__render_phases.items():
+                if phase + '_seconds' in stats:
+                    histogram.observe(stats[phase + '_seconds'])
+
+            if self.dry_run:
+                print("Created image for story\n    %s\n    %s\n    %s" % (link.title, link.comment_page(), image))
+                self.__finished(link, True)
+            else:
+                self.journal.rendered(link, image, stats.get('extension', '.png'))
+                self.__put(self.__upload_queue, (link, image, stats.get('extension', '.png')))
+
+    def __upload(self):
+        while True:
+            item = self.__upload_queue.get()
+            if item is None:
+                return
+            link, image, extension = item
+
+            # Tiled screenshots are a list of images which each get uploaded
+            if not isinstance(image, list):
+                image = [image]
+
+            # An identical screenshot may already have been uploaded for another page
+            page = uploadcache.canonical_url(link.href)
+            image_hash = uploadcache.image_hash(image)
+            imgur_link = self.upload_cache.get(image_hash)
+            if imgur_link:
+                self.upload_cache.add(imgur_link, page)
+                self.__uploaded(link, page, imgur_link)
+                self.__comment(link, imgur_link)
+                continue
+
+            started = time.time()
+            try:
+                imgur_link = ' '.join([self.profiler.run('upload', self.imgur.upload_data, tile, extension) for tile in image])
+                self.counters['upload'].record(time.time() - started)
+            except Exception, e:
+                self.counters['upload'].record(time.time() - started, False)
+                self.__failed(link, e)
+                continue
+            self.upload_cache.add(imgur_link, page, image_hash)
+            self.__uploaded(link, page, imgur_link)
+
+            print("Uploaded image for story\n    %s\n    %s\n    %s" % (link.title, link.comment_page(), imgur_link))
+            self.__comment(link, imgur_link)
+
+    def __comment(self, link, imgur_link):
+        # The uploaded link waits in the journal for the poster thread, in a
+        # cluster one worker posts every comment and the queue in the
+        # coordinator's database keeps them until it does
+        if self.coordinator:
+            self.coordinator.queue_comment(link, imgur_link)
+            print("Queued imgur cache for the poster for story\n    %s\n    %s" % (link.title, link.comment_page()))
+            self.__finished(link, True)
+
+    def __comments(self):
+        # The jobs waiting for their comment, a job resumed from the journal
+        # only once discovery has checked it is still wanted
+        jobs = self.journal.uploaded_jobs()
+        with self.__lock:
+            return [job for job in jobs if job.fullname() in self.__in_flight]
+
+    def __post(self):
+        # Post comments, the longest waiting first, until we are asked to
+        # stop rather than waiting out the comment interval for every one
+        # left, they stay in the journal until the restart
+        backoff = scheduler.Backoff(60)
+        while not self.__stopping.isSet():
+            jobs = self.__comments()
+            if not jobs:
+                self.__stopping.wait(0.5)
+                continue
+            link, imgur_link = _job_link(jobs[0]), jobs[0].imgur_link
+
+            try:
+                if not self.__submit(link, imgur_link, backoff, self.__stopping):
+                    self.__finished(link)
+                    continue
+            except Exception, e:
+                self.__failed(link, e)
+                continue
+            print("Posted imgur cache for story\n    %s\n    %s" % (link.title, link.comment_page()))
+            self.__finished(link, True)
+
+    def __post_shared(self):
+        # While this worker holds the poster lease post the comments queued
+        # by every worker, until we are asked to stop
+        backoff = scheduler.Backoff(60)
+        while not self.__stopping.isSet():
+            item = self.coordinator.is_poster() and self.coordinator.next_comment()
+            if not item:
+                self.__stopping.wait(5)
+                continue
+            link, imgur_link = item
+
+            # The comment interval carries on from the last post of any
+            # worker, so taking over as the poster doesn't mean posting early
+            self.__cooldown.extend(self.coordinator.last_posted() + self.comment_interval - time.time())
+
+            # Another worker may become the poster while we wait to post
+            try:
+                if not self.__submit(link, imgur_link, backoff, self.__stopping, self.coordinator.is_poster):
+                    continue
+            except Exception, e:
+                if self.coordinator.comment_failed(link, e):
+                    print('ERROR: %s: %s, giving up on the comment' % (link.href, str(e)))
+                else:
+                    print('ERROR: %s: %s' % (link.href, str(e)))
+                continue
+            self.coordinator.comment_posted(link)
+            print("Posted imgur cache for story\n    %s\n    %s" % (link.title, link.comment_page()))
+
+    def __submit(self, link, imgur_link, backoff, stop_event=None, allowed=None):
+        # Only this stage is throttled to avoid reddit thinking 'FLOOD'
+        # If reddit tells us to slow down keep the comment and try it again
+        # later rather than rendering and uploading the link all over again
+        # Returns True once posted, or False without posting if stop_event is
+        # set while waiting or allowed() returns False once we have waited
+        while True:
+            if not self.__cooldown.wait(stop_event) or (allowed and not allowed()):
+                return False
+            started = time.time()
+            try:
+                self.profiler.run('comment', self.reddit.submit_comment, link, 'Imgur cache: %s' % (imgur_link))
+                self.counters['comment'].record(time.time() - started)
+                backoff.succeeded()
+                return True
+            except Exception, e:
+                self.counters['comment'].record(time.time() - started, False)
+                delay = scheduler.throttle_delay(e)
+                if delay is None or backoff.failures >= self.comment_retries:
+                    backoff.succeeded()
+                    raise
+                delay = backoff.failed(delay)
+                print("> Reddit asked us to slow down, waiting %d seconds before posting again" % (delay))
+                self.__cooldown.extend(delay)
+
+    def __put(self, queue, item, give_up_on_stop=False):
+        # Block while the queue is full, with a timeout so Ctrl-C still works
+        # Discovery gives up if we are asked to stop, later stages always finish
+        while not (give_up_on_stop and self.__stopping.isSet()):
+            try:
+                queue.put(item, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __uploaded(self, link, page, imgur_link):
+        # Other posts of the page can now use the cached imgur link
+        self.journal.uploaded(link, imgur_link)
+        with self.__lock:
+            self.__in_flight_pages.discard(page)
+
+    def __failed(self, link, error):
+        # The journal decides when the link is tried again, if ever
+        job = self.journal.failed(link, error)
+        if job is not None and job.state == journal.DEAD:
+            print('ERROR: %s: %s, giving up after %d attempts' % (link.href, str(error), job.attempts))
+        else:
+            print('ERROR: %s: %s' % (link.href, str(error)))
+        with self.__lock:
+            self.__in_flight.discard(link.fullname)
+            self.__in_flight_pages.discard(uploadcache.canonical_url(link.href))
+        self.__let_go(link)
+        self.__outcomes['errored'].inc()
+
+    def __finished(self, link, processed=False, outcome='processed'):
+        with self.__lock:
+            self.__in_flight.discard(link.fullname)
+            self.__in_flight_pages.discard(uploadcache.canonical_url(link.href))
+            if processed:
+                self.processed.add(link.fullname)
+        if processed:
+            self.journal.commented(link)
+            if self.coordinator:
+                self.coordinator.done(link)
+            self.__outcomes[outcome].inc()
+        else:
+            self.__let_go(link)
+
+    def __skipped(self, link, done=False):
+        # Count a link we aren't working on, if it needs nothing more doing
+        # the coordinator can forget it
+        self.__outcomes['skipped'].inc()
+        if not self.coordinator:
+            return
+        job = self.journal.get(link.fullname)
+        if done:
+            self.coordinator.done(link)
+        elif job is None or job.state != journal.ACTIVE:
+            self.__let_go(link)
+
+    def __let_go(self, link):
+        # Keep the lease on a link we stopped working on while the journal is
+        # waiting to try it again, otherwise let its owner take it again
+        if not self.coordinator:
+            return
+        job = self.journal.get(link.fullname)
+        if job is not None and job.state == journal.WAITING:
+            self.coordinator.hold(link, job.retry_at)
+        elif job is not None and job.state == journal.DEAD:
+            self.coordinator.done(link)
+        else:
+            self.coordinator.release(link)
+
+    def __drained(self, queue, feeders):
+        # True once we are stopping, every thread putting items on the queue
+        # has finished and nothing is left on it
+        if not self.__stopping.isSet():
+            return False
+        for thread in feeders:
+            if thread.isAlive():
+                return False
+        return queue.empty()
+
+    def __renderer_memory(self):
+        # A pool renders in its worker processes, otherwise WebKit is in this one
+        if hasattr(self.renderer, 'pids'):
+            sizes = [metrics.process_memory(pid) for pid in self.renderer.pids()]
+            return sum([size for size in sizes if size is not None])
+        return metrics.process_memory()
+
+    def __shutdown(self):
+        # Discovery has stopped and rendering has drained so drain the
+        # uploaders, the comments not posted yet are left in the journal
+        # and the poster stops straight away
+        self.__join(self.__discovery_thread)
+        for thread in self.__preflight_threads:
+            self.__join(thread)
+        for thread in self.__render_threads:
+            self.__join(thread)
+        if self.dry_run:
+            return
+        for thread in self.__upload_threads:
+            self.__put(self.__upload_queue, None)
+        for thread in self.__upload_threads:
+            self.__join(thread)
+        if self.__post_thread:
+            self.__join(self.__post_thread)
+        if self.__shared_post_thread:
+            self.__join(self.__shared_post_thread)
+
+    def __join(self, thread):
+        # Join with a timeout so Ctrl-C still works while we wait
+        while thread.isAlive():
+            thread.join(0.5)
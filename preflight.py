@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# preflight.py
+# A cheap check that a page is still there before it is rendered, so
+# deleted, flagged or expired posts never reach WebKit
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import urllib2
+import transport
+
+# What craigslist shows in place of a post that has been taken down
+CRAIGSLIST_REMOVED = ('This posting has been deleted by its author',
+                      'This posting has been flagged for removal',
+                      'This posting has expired',
+                      'This posting has been removed')
+
+# Statuses that mean a page has gone for good, other errors may be temporary
+GONE_STATUSES = (404, 410)
+
+class PreflightChecker:
+    """
+    Fetches the start of a page with a plain HTTP request to find out if it
+    has been taken down before it is rendered. A page is gone if the
+    server says it is not found, or the first max_bytes of it contain one
+    of the markers, which are matched ignoring case.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self, http=None, markers=CRAIGSLIST_REMOVED, max_bytes=32 * 1024):
+        """
+        Pass a transport.HttpTransport to share connections with the apis.
+        """
+        if http is None:
+            http = transport.HttpTransport()
+        self.http = http
+        self.markers = markers
+        self.max_bytes = max_bytes
+        self.__markers = [marker.lower() for marker in markers]
+
+    def check(self, url):
+        """
+        Returns None if the page is still there, or why it is gone.
+        Raises the error if the page couldn't be fetched for a reason that
+        may pass, such as a server error or a timeout, so it can be tried later.
+        """
+        try:
+            response = self.http.open(url, headers={ 'Accept': 'text/html' }, max_bytes=self.max_bytes)
+        except urllib2.HTTPError, e:
+            if e.code in GONE_STATUSES:
+                return 'HTTP %d %s' % (e.code, e.msg)
+            raise
+
+        start = response.read().lower()
+        for marker, lower_marker in zip(self.markers, self.__markers):
+            if lower_marker in start:
+                return marker
+        return None
+
+if __name__ == '__main__':
+    # Check a couple of pages
+    checker = PreflightChecker()
+    for url in ('http://sfbay.craigslist.org/', 'http://sfbay.craigslist.org/sfc/apa/0.html'):
+        print("%s: %s" % (url, checker.check(url) or 'still there'))
@@ -24,7 +24,10 @@ import HTMLParser
 import urllib
 import urllib2
 import cookielib
+import collections
 import re
+import transport
+import asynchttp
 
 try:
     import json
@@ -32,10 +35,21 @@ except:
     print("Failed to load json, requires Python 2.6 or later")
     sys.exit(1)
 
-class RedditLink:
+# How far back each links_from value passed to RedditApi.search reaches, in seconds
+LINKS_FROM_SECONDS = {
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+    'month': 31 * 24 * 60 * 60,
+    'year': 366 * 24 * 60 * 60,
+}
+
+class RedditLink(object):
     """
     Store a link from reddit.com along with metadata.
+    Uses slots as a search can return hundreds of these at a time.
     """
+    __slots__ = ('title', 'href', 'subreddit', 'domain', 'name', 'fullname')
 
     def __init__(self, title, href, subreddit, domain, name, fullname):
         self.title = title
@@ -51,13 +65,196 @@ class RedditLink:
     def comment_page(self):
         return 'http://reddit.com/r/' + self.subreddit + '/comments/' + self.name
 
+def _search_params(query, sorted_by, links_from):
+    # Validate parameters
+    if not (sorted_by == None or
+            sorted_by == 'new' or
+            sorted_by == 'top' or
+            sorted_by == 'old' or
+            sorted_by == 'hot'):
+        raise ValueError('sorted_by must be one of: new, top, old, hot (or None for relevance)')
+    
+    if not (links_from == None or
+            links_from == 'hour' or
+            links_from == 'day' or
+            links_from == 'week' or
+            links_from == 'month' or
+            links_from == 'year'):
+        raise ValueError('links_from must be one of: year, month, week, day, hour (or None for all-time)')
+    
+    params = [('q', query)]
+    if sorted_by: params += [('sort', sorted_by)]
+    if links_from: params += [('t', links_from)]
+    return params
+
+def _search_url(params):
+    return "http://www.reddit.com/search.json?" + urllib.urlencode(params)
+
+def domain_matcher(*suffixes):
+    """
+    Returns a predicate for the accept_domain argument of searches which is
+    True for any of the given domains or their subdomains, so
+    domain_matcher('craigslist.org') accepts sfbay.craigslist.org.
+    """
+    domains = tuple([suffix.lower().lstrip('.') for suffix in suffixes])
+    subdomains = tuple(['.' + domain for domain in domains])
+    def matches(domain):
+        domain = domain.lower()
+        return domain in domains or domain.endswith(subdomains)
+    return matches
+
+# The start of the list of links in a search listing
+LISTING_CHILDREN = re.compile(r'"children"\s*:\s*\[\s*')
+WHITESPACE = re.compile(r'\s*')
+
+class _Listing:
+    # One page of search results, parsed a link at a time
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.count = 0 # Links on the page, including ones not accepted
+        self.first = None # Fullname of the first link on the page
+        self.after = None # Only known once every link has been read
+        self.before = None
+
+    def links(self, accept_domain=None):
+        """
+        Yields a RedditLink for each link on the page whose domain is accepted,
+        decoding one link's json at a time rather than the whole page at once.
+        """
+        contents = self.contents
+        match = LISTING_CHILDREN.search(contents)
+        if match is None:
+            raise ValueError('Reddit did not return a list of links: %s' % (contents[:100]))
+        decoder = json.JSONDecoder()
+        position = match.end()
+        while contents[position] != ']':
+            child, position = decoder.raw_decode(contents, position)
+            position = WHITESPACE.match(contents, position).end()
+            if contents[position] == ',':
+                position = WHITESPACE.match(contents, position + 1).end()
+
+            link = child['data']
+            self.count += 1
+            if self.first is None:
+                self.first = link['name']
+            if accept_domain is None or accept_domain(link['domain']):
+                yield RedditLink(link['title'], link['url'], link['subreddit'], link['domain'], link['id'], link['name'])
+
+        # Decode the rest of the listing with the links taken out
+        data = json.loads(contents[:match.start()] + '"children": []' + contents[position + 1:])['data']
+        self.after = data.get('after')
+        self.before = data.get('before')
+
+def _login_data(username, password):
+    return urllib.urlencode([('op', 'login-main'),
+                             ('user', username),
+                             ('passwd', password)])
+
+def _logged_in(contents, username):
+    # Figure out if we logged in
+    # The status code is always 200 so look at the contents
+    # If we have logged in we see: "logged: 'username'" in the js reddit object
+    return contents.find("logged: '%s'" % (username)) != -1
+
+def _page_modhash(contents):
+    # Returns the anti-XSRF token from the js reddit object in a page, or None
+    modhash = re.search(r"modhash: '([^']+)'", contents)
+    return modhash and modhash.group(1)
+
+def _me_modhash(contents):
+    # Returns the anti-XSRF token from the logged in user's details
+    try:
+        return json.loads(contents)['data']['modhash'] or None
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _comment_target(page, reply_to_fullname, link_type):
+    # Returns the subreddit and thing id to comment on from a RedditLink or
+    # the url of its comments page, unless replying to another thing
+    if isinstance(page, RedditLink):
+        subreddit, thing_id = page.subreddit, page.fullname
+    else:
+        url_parts = re.match(r"http[s]{0,1}://([^/]*)/r/([^/]*)/comments/([^/]*)", page)
+        if url_parts is None:
+            raise ValueError('Not a reddit comments page: %s' % (page))
+        subreddit, thing_id = url_parts.group(2), link_type + url_parts.group(3)
+    return subreddit, reply_to_fullname or thing_id
+
+def _comment_data(subreddit, thing_id, modhash, comment):
+    return urllib.urlencode([('thing_id', thing_id),
+                             ('r', subreddit),
+                             ('uh', modhash),
+                             ('text', comment)])
+
+# Comment errors which mean our session or its modhash is no longer valid
+AUTH_ERRORS = ('USER_REQUIRED', 'BAD_MODHASH')
+
+# Where to find the logged in user's details, including the modhash
+ME_URL = 'http://www.reddit.com/api/me.json'
+
+def _comment_error(result):
+    # Returns the error code from a comment submission, or None if it worked
+    error_code = re.search('"\.error\.([A-Z_]*)"', result)
+    return error_code and error_code.group(1)
+
+def _comment_exception(error_code, result):
+    # Pass on how long reddit wants us to wait if it is rate limiting us
+    wait = re.search(r'try again in \d+ (second|minute)', result)
+    if wait:
+        return RuntimeError('Error posting comment: %s, %s' % (error_code, wait.group(0)))
+    return RuntimeError('Error posting comment: %s' % (error_code))
+
+class SearchCursor:
+    """
+    Remembers how far a search got so RedditApi.search_new can ask only for
+    links posted since the last time.
+    """
+
+    def __init__(self, query, links_from=None, limit=100, max_pages=10, resync_every=30, remember=1000, accept_domain=None):
+        """
+        Pass the search query and how far back to search, and optionally which
+        domains to return links for (see RedditApi.search).
+        Up to max_pages of limit links are fetched each time. Every
+        resync_every searches the whole listing is fetched again in case the
+        newest link has been deleted, and the last remember links are kept
+        so they aren't returned twice.
+        """
+        self.query = query
+        self.links_from = links_from
+        self.limit = limit
+        self.max_pages = max_pages
+        self.resync_every = resync_every
+        self.accept_domain = accept_domain
+
+        self.newest = None
+        self.polls = 0
+        self.conditional_url = None
+        self.etag = None
+        self.last_modified = None
+        self.seen = set()
+        self.__seen_order = collections.deque()
+        self.__remember = remember
+
+    def saw(self, links):
+        """
+        Remember links returned by a search so they aren't returned again.
+        """
+        for link in reversed(links):
+            self.seen.add(link.fullname)
+            self.__seen_order.append(link.fullname)
+        while len(self.__seen_order) > self.__remember:
+            self.seen.discard(self.__seen_order.popleft())
+
 class RedditApi:
     """
     A class for using the social bookmark site reddit.com
     """
-    def __init__(self, username, password):
+    def __init__(self, username, password, http_transport=None):
         """
         Pass the username and password to create an object to access reddit.com
+        Optionally pass a transport.HttpTransport to share connections with
+        other apis, its cookie jar is used to stay logged in.
         """
         self.username = username
         self.password = password
@@ -65,9 +262,13 @@ class RedditApi:
         self.link_type = 't3_' # The 3 may have to change this for reddit installations other than reddit.com
 
         # Set up the cookie jar and login for the first time
+        # The modhash reddit wants with each post is kept for the session
         self.logged_in = False
-        self.__cookiejar = cookielib.CookieJar()
-        self.url_opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.__cookiejar))
+        self.modhash = None
+        if http_transport is None:
+            http_transport = transport.HttpTransport(cookielib.CookieJar())
+        self.__cookiejar = http_transport.cookiejar
+        self.url_opener = http_transport
         self.login()
 
     def login(self):
@@ -82,99 +283,173 @@ class RedditApi:
         if self.logged_in:
             return True
         
-        response = self.url_opener.open('http://www.reddit.com/post/login',
-                                        urllib.urlencode([('op', 'login-main'),
-                                                          ('user', self.username),
-                                                          ('passwd', self.password)]))
+        response = self.url_opener.open('http://www.reddit.com/post/login', _login_data(self.username, self.password))
         contents = response.read()
         response.close()
-                                          
-        # Figure out if we logged in
-        # The status code is always 200 so look at the contents
-        # If we have logged in we see: "logged: 'username'" in the js reddit object
-        if contents.find("logged: '%s'" % (self.username)) != -1:
-            self.logged_in = True
+        self.logged_in = _logged_in(contents, self.username)
+        if self.logged_in:
+            self.modhash = _page_modhash(contents)
             
         return self.logged_in
 
-    def search(self, query, sorted_by=None, links_from=None):
+    def get_modhash(self):
+        """
+        Returns the anti-XSRF token reddit wants with each post, logging in
+        if necessary. It is fetched once per session and kept until reddit
+        says the session is no longer valid.
+        """
+        if not self.modhash and self.login():
+            if not self.modhash:
+                response = self.url_opener.open(ME_URL)
+                self.modhash = _me_modhash(response.read())
+                response.close()
+        if not self.modhash:
+            raise RuntimeError('Could not get a modhash from reddit, check the username and password')
+        return self.modhash
+
+    def search(self, query, sorted_by=None, links_from=None, accept_domain=None):
         """
         Search reddit for the given query values.
         Returns a list of RedditLink items.
+        If accept_domain is given only links for which accept_domain(domain)
+        is True are returned (see domain_matcher), the rest are skipped
+        without making RedditLink items for them.
         """
-        # Validate parameters
-        if not (sorted_by == None or
-                sorted_by == 'new' or
-                sorted_by == 'top' or
-                sorted_by == 'old' or
-                sorted_by == 'hot'):
-            raise ValueError('sorted_by must be one of: new, top, old, hot (or None for relevance)')
-        
-        if not (links_from == None or
-                links_from == 'hour' or
-                links_from == 'day' or
-                links_from == 'week' or
-                links_from == 'month' or
-                links_from == 'year'):
-            raise ValueError('links_from must be one of: year, month, week, day, hour (or None for all-time)')
-        
-        url = "http://www.reddit.com/search.json"
-        params = [('q', query)]
-        if sorted_by: params += [('sort', sorted_by)]
-        if links_from: params += [('t', links_from)]
-        
-        page = self.url_opener.open(url + "?" + urllib.urlencode(params))
-        contents = page.read()
-        page.close()
-        results = json.loads(contents)
-        
-        links = []
-        for link_meta in results['data']['children']:
-            link = link_meta['data']
-            links += [RedditLink(link['title'], link['url'], link['subreddit'], link['domain'], link['id'], link['name'])]
+        params = _search_params(query, sorted_by, links_from)
+        listing = self.__fetch_listing(params)[1]
+        return list(listing.links(accept_domain))
+
+    def iter_search(self, query, sorted_by=None, links_from=None, limit=100, max_pages=None, accept_domain=None):
+        """
+        Search reddit for the given query values, following the after= cursor
+        from page to page until the results run out (or max_pages have been read).
+        Yields RedditLink items as each page is parsed rather than returning a list.
+        """
+        params = _search_params(query, sorted_by, links_from) + [('limit', limit)]
+        after = None
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            page_params = params
+            if after:
+                page_params = params + [('after', after)]
+            listing = self.__fetch_listing(page_params)[1]
+            pages += 1
+
+            for link in listing.links(accept_domain):
+                yield link
 
+            after = listing.after
+            if not after:
+                break
+
+    def search_page(self, query, sorted_by=None, links_from=None, limit=100, after=None, accept_domain=None):
+        """
+        Fetch one page of a search, starting after the link with the given
+        fullname. Returns a list of RedditLink items and the after= value for
+        the next page, which is None on the last page.
+        """
+        params = _search_params(query, sorted_by, links_from) + [('limit', limit)]
+        if after:
+            params += [('after', after)]
+        listing = self.__fetch_listing(params)[1]
+        return list(listing.links(accept_domain)), listing.after
+
+    def search_new(self, cursor):
+        """
+        Returns a list of the RedditLink items for a search that are newer than
+        the ones returned last time the same SearchCursor was passed in, newest first.
+        Only asks reddit for links before= the newest one seen, and sends a
+        conditional request so an unchanged listing costs a 304.
+        The first call returns everything the search finds.
+        """
+        cursor.polls += 1
+        params = _search_params(cursor.query, 'new', cursor.links_from) + [('limit', cursor.limit)]
+
+        # If the newest link we saw gets deleted reddit returns nothing before
+        # it, so now and again fetch the listing without before= to catch up
+        resync = not cursor.newest or cursor.polls % cursor.resync_every == 0
+        if not resync:
+            params += [('before', cursor.newest)]
+
+        url = _search_url(params)
+        headers = {}
+        if url == cursor.conditional_url:
+            if cursor.etag:
+                headers['If-None-Match'] = cursor.etag
+            if cursor.last_modified:
+                headers['If-Modified-Since'] = cursor.last_modified
+        response, listing = self.__fetch_listing(params, headers)
+        if listing is None:
+            return []
+        cursor.conditional_url = url
+        cursor.etag = response.info().getheader('etag')
+        cursor.last_modified = response.info().getheader('last-modified')
+
+        # Links from other domains are dropped as they are parsed, but still
+        # count towards the page being full and where the next page starts
+        links = list(listing.links(cursor.accept_domain))
+        newest = listing.first
+        if not resync:
+            # There may be more new links than fit on one page, the ones
+            # before the newest of this page are newer still
+            for page in range(cursor.max_pages - 1):
+                if listing.count < cursor.limit:
+                    break
+                listing = self.__fetch_listing(params[:-1] + [('before', newest)])[1]
+                links = list(listing.links(cursor.accept_domain)) + links
+                newest = listing.first or newest
+
+        if newest:
+            cursor.newest = newest
+        links = [link for link in links if link.fullname not in cursor.seen]
+        cursor.saw(links)
         return links
 
-    def submit_comment(self, comment_page_url, comment, reply_to_fullname='', retry=True):
+    def __fetch_listing(self, params, headers=None):
+        # Returns the response and a _Listing to read the links from (None for a 304)
+        page = self.url_opener.open(_search_url(params), headers=headers)
+        contents = page.read()
+        page.close()
+        if page.code == 304:
+            return page, None
+        return page, _Listing(contents)
+
+    def submit_comment(self, page, comment, reply_to_fullname='', retry=True):
         """
         Submit a comment to reddit.com.
-        Pass the page containg the comments from which the subreddit will be extracted.
-        If retry is set to True then if the user is not logged in 
+        Pass the RedditLink to comment on, or the url of its comments page,
+        from which the subreddit and link are taken without fetching the page.
+        If retry is set to True then if reddit says we are not logged in we
+        log in again and try once more.
         Throws an exception if unsuccessful.
         """
-        # Fetch the comments page to extract the anti-XSRF token
-        response = self.url_opener.open(comment_page_url)
-        modhash = re.search(r"modhash: '([^']*)'", response.read()).group(1)
-        response.close()
-        
-        # Figure out the rest of the parameters from the url or passed in values
-        url_parts = re.match(r"http[s]{0,1}://([^/]*)/r/([^/]*)/comments/([^/]*)", comment_page_url)
-        subreddit = url_parts.group(2)
-        if not reply_to_fullname:
-            reply_to_fullname = self.link_type + url_parts.group(3)
-
-        # Submit the comment
-        response = self.url_opener.open('http://www.reddit.com/api/comment',
-                                        urllib.urlencode([('thing_id', reply_to_fullname),
-                                                          ('r', subreddit),
-                                                          ('uh', modhash),
-                                                          ('text', comment)]))
-        result = response.read()
-        response.close()
+        subreddit, thing_id = _comment_target(page, reply_to_fullname, self.link_type)
+        data = _comment_data(subreddit, thing_id, self.get_modhash(), comment)
+
+        # Submit the comment, a stale modhash may be refused outright
+        try:
+            response = self.url_opener.open('http://www.reddit.com/api/comment', data)
+            result = response.read()
+            response.close()
+            error_code = _comment_error(result)
+        except urllib2.HTTPError, e:
+            if e.code != 403:
+                raise
+            result = e.read()
+            error_code = 'USER_REQUIRED'
         
         # Test the various responses
-        error_code = re.search('"\.error\.([A-Z_]*)"', result)
         if error_code:
-            # If we are not logged in try and log in 
-            if error_code.group(1) == '.error.USER_REQUIRED':
+            # If we are not logged in try and log in and fetch a new modhash
+            if error_code in AUTH_ERRORS:
                 self.logged_in = False
-                self.login()
-                if self.logged_in and retry:
-                    return self.submit_comment(comment_page_url, comment, reply_to_fullname, False)
+                self.modhash = None
+                if retry and self.login():
+                    return self.submit_comment(page, comment, reply_to_fullname, False)
                 else:
                     raise RuntimeError('Error posting comment: User required - attempted to log in again')
             else:
-                raise RuntimeError('Error posting comment: %s' % (error_code.group(1)))
+                raise _comment_exception(error_code, result)
 
     def submit_link(self, title, url, subreddit='reddit.com'):
         """
@@ -191,6 +466,98 @@ class RedditApi:
         response.close()
         raise NotImplementedError("Submitting links does not work yet.")
 
+class AsyncRedditApi:
+    """
+    The reddit.com api for use with asynchttp, so searches and comments can
+    run alongside other requests on one event loop. Methods return
+    asynchttp.Task results instead of waiting for reddit.
+    """
+
+    def __init__(self, username, password, client=None):
+        """
+        Pass the username and password, and optionally an
+        asynchttp.AsyncHttpClient to share its event loop and cookies with
+        other apis. Call login() (or just submit a comment) to log in.
+        """
+        self.username = username
+        self.password = password
+
+        self.link_type = 't3_'
+
+        self.logged_in = False
+        self.modhash = None
+        if client is None:
+            client = asynchttp.AsyncHttpClient()
+        self.client = client
+
+    def login(self):
+        """
+        Login to reddit, the task's value is True if successful.
+        """
+        return self.client.spawn(self.__login())
+
+    def search(self, query, sorted_by=None, links_from=None, accept_domain=None):
+        """
+        Search reddit for the given query values, the task's value is a list of RedditLink items.
+        """
+        return self.client.spawn(self.__search(query, sorted_by, links_from, accept_domain))
+
+    def submit_comment(self, comment_page_url, comment, reply_to_fullname='', retry=True):
+        """
+        Submit a comment to reddit.com on a RedditLink or the url of its
+        comments page, logging in again once if reddit says we are not
+        logged in. The task fails if the comment was not posted.
+        """
+        return self.client.spawn(self.__submit_comment(comment_page_url, comment, reply_to_fullname, retry))
+
+    def __login(self):
+        if not self.username:
+            self.logged_in = False
+        elif not self.logged_in:
+            response = yield self.client.open('http://www.reddit.com/post/login', _login_data(self.username, self.password))
+            contents = response.read()
+            self.logged_in = _logged_in(contents, self.username)
+            if self.logged_in:
+                self.modhash = _page_modhash(contents)
+        yield asynchttp.Return(self.logged_in)
+
+    def __get_modhash(self):
+        if not self.modhash:
+            logged_in = yield self.__login()
+            if logged_in and not self.modhash:
+                response = yield self.client.open(ME_URL)
+                self.modhash = _me_modhash(response.read())
+        if not self.modhash:
+            raise RuntimeError('Could not get a modhash from reddit, check the username and password')
+        yield asynchttp.Return(self.modhash)
+
+    def __search(self, query, sorted_by, links_from, accept_domain):
+        response = yield self.client.open(_search_url(_search_params(query, sorted_by, links_from)))
+        yield asynchttp.Return(list(_Listing(response.read()).links(accept_domain)))
+
+    def __submit_comment(self, page, comment, reply_to_fullname, retry):
+        subreddit, thing_id = _comment_target(page, reply_to_fullname, self.link_type)
+        modhash = yield self.__get_modhash()
+        try:
+            response = yield self.client.open('http://www.reddit.com/api/comment', _comment_data(subreddit, thing_id, modhash, comment))
+            result = response.read()
+            error_code = _comment_error(result)
+        except urllib2.HTTPError, e:
+            if e.code != 403:
+                raise
+            result = e.read()
+            error_code = 'USER_REQUIRED'
+
+        if error_code in AUTH_ERRORS:
+            self.logged_in = False
+            self.modhash = None
+            logged_in = yield self.__login()
+            if not (logged_in and retry):
+                raise RuntimeError('Error posting comment: User required - attempted to log in again')
+            yield self.__submit_comment(page, comment, reply_to_fullname, False)
+        elif error_code:
+            raise _comment_exception(error_code, result)
+
 if __name__ == '__main__':
     # Test the classes
     username = raw_input("Enter reddit.com username: ")
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#
+# renderpool.py
+# Render web pages in several worker processes, each with its own warm
+# WebshotRenderer, so screenshots can use more than one core
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import sys
+import copy
+import Queue
+import signal
+import threading
+
+try:
+    import multiprocessing
+except:
+    print("Failed to load multiprocessing, requires Python 2.6 or later")
+    sys.exit(1)
+
+class RenderFuture:
+    """
+    The result of a render that may not have finished yet.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.__done = threading.Event()
+        self.__result = None
+        self.__error = None
+        self.stats = {}
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def done(self):
+        """
+        Returns True if the render has finished, successfully or not.
+        """
+        return self.__done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the render and return its result, raising an exception if it
+        failed or if it has not finished within timeout seconds.
+        """
+        self.__done.wait(timeout)
+        if not self.__done.isSet():
+            raise RuntimeError("Timed out waiting for render of %s" % (self.url))
+        if self.__error:
+            raise self.__error
+        return self.__result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the render and return the exception it failed with, or None.
+        """
+        try:
+            self.result(timeout)
+        except Exception, e:
+            return e
+        return None
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) when the render finishes (straight away if it already has).
+        """
+        with self.__lock:
+            if not self.done():
+                self.__callbacks += [callback]
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self.__result = result
+        self.__finish()
+
+    def set_exception(self, error):
+        self.__error = error
+        self.__finish()
+
+    def __finish(self):
+        with self.__lock:
+            self.__done.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+def _worker_main(connection, policy):
+    # Ctrl-C reaches the whole process group, so ignore it here and let the
+    # parent finish the renders in progress before telling us to quit
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Runs in the worker process: create the renderer once and keep it warm
+    # for every url we are sent until we are told to quit with None
+    import webshot
+    renderer = webshot.WebshotRenderer(policy=policy)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        url, timeout_seconds, as_data, options = request
+        try:
+            result, stats = renderer.render(url, timeout_seconds, as_data, options, True)
+            connection.send((True, result, stats))
+        except Exception, e:
+            connection.send((False, str(e), renderer.stats))
+    connection.close()
+
+class RendererPool:
+    """
+    A pool of worker processes each running its own WebshotRenderer.
+    Workers that hang or crash are killed and replaced, and each worker is
+    replaced after renders_per_worker pages to cap WebKit's memory growth.
+    """
+
+    def __init__(self, processes=2, renders_per_worker=50, timeout_seconds=300, hang_seconds=30, options=None, policy=None):
+        """
+        Start the given number of worker processes.
+        A worker is considered hung if it hasn't answered hang_seconds after
+        the render timeout has passed.
+        Pass a webshot.ImageOptions to change how screenshots are saved by default
+        and a webshot.LoadPolicy to control what pages are allowed to load.
+        """
+        self.processes = processes
+        self.options = options
+        self.policy = policy
+        self.renders_per_worker = renders_per_worker
+        self.timeout_seconds = timeout_seconds
+        self.hang_seconds = hang_seconds
+
+        self.__requests = Queue.Queue()
+        self.__start_lock = threading.Lock()
+        self.__processes = {} # slot -> the slot's worker process, if it has one
+        self.__threads = []
+        for i in range(processes):
+            thread = threading.Thread(target=self.__manage_worker, args=(i,))
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads += [thread]
+
+    def submit(self, url, timeout_seconds=None, as_data=False, options=None):
+        """
+        Queue a url for rendering and return a RenderFuture whose result is the
+        temporary filename of the screenshot, or the png data if as_data is
+        True (see WebshotRenderer.render). Once the future is done its stats
+        attribute holds the render stats.
+        """
+        if timeout_seconds is None:
+            timeout_seconds = self.timeout_seconds
+        if options is None:
+            options = self.options
+        future = RenderFuture(url)
+        self.__requests.put((future, timeout_seconds, as_data, options))
+        return future
+
+    def render(self, url, timeout_seconds=None, as_data=False, options=None, with_stats=False):
+        """
+        Render a url and wait for the result, so the pool can be used in
+        place of a WebshotRenderer.
+        """
+        future = self.submit(url, timeout_seconds, as_data, options)
+        result = future.result()
+        if with_stats:
+            return result, future.stats
+        return result
+
+    def pids(self):
+        """
+        Returns the process ids of the running worker processes.
+        """
+        return [process.pid for process in self.__processes.values() if process is not None]
+
+    def close(self):
+        """
+        Finish any queued renders and stop the worker processes.
+        """
+        for thread in self.__threads:
+            self.__requests.put(None)
+        for thread in self.__threads:
+            while thread.isAlive():
+                thread.join(0.5)
+        self.__threads = []
+
+    def __start_worker(self, slot):
+        # Webkit's disk cache can't be shared between processes so each slot
+        # gets its own, which survives the worker being replaced
+        policy = self.policy
+        if policy is not None and policy.cache_directory:
+            policy = copy.copy(policy)
+            policy.cache_directory = os.path.join(policy.cache_directory, 'worker%d' % (slot))
+
+        # Start workers one at a time so a worker doesn't inherit another's end
+        # of its pipe, which would stop us noticing when that worker dies
+        with self.__start_lock:
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker_main, args=(worker_connection, policy))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+        self.__processes[slot] = process
+        return process, connection
+
+    def __stop_worker(self, slot, process, connection, kill=False):
+        self.__processes[slot] = None
+        if not kill:
+            try:
+                connection.send(None)
+                process.join(self.hang_seconds)
+            except (IOError, EOFError):
+                pass
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        connection.close()
+
+    def __manage_worker(self, slot):
+        # Each worker process is looked after by one of these threads which
+        # hands it requests and replaces it when necessary
+        process, connection = None, None
+        renders = 0
+        while True:
+            request = self.__requests.get()
+            if request is None:
+                break
+            future, timeout_seconds, as_data, options = request
+
+            if process is None:
+                process, connection = self.__start_worker(slot)
+                renders = 0
+
+            try:
+                connection.send((future.url, timeout_seconds, as_data, options))
+                if not connection.poll(timeout_seconds + self.hang_seconds):
+                    raise RuntimeError("Renderer hung while rendering %s" % (future.url))
+                succeeded, result, future.stats = connection.recv()
+            except Exception, e:
+                # The worker hung or died, replace it with a new one
+                self.__stop_worker(slot, process, connection, True)
+                process, connection = None, None
+                if isinstance(e, (IOError, EOFError)):
+                    e = RuntimeError("Renderer crashed while rendering %s" % (future.url))
+                future.set_exception(e)
+                continue
+
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+            renders += 1
+            if renders >= self.renders_per_worker:
+                self.__stop_worker(slot, process, connection)
+                process, connection = None, None
+
+        if process is not None:
+            self.__stop_worker(slot, process, connection)
+
+if __name__ == '__main__':
+    # Test the pool by rendering a few pages at once
+    pool = RendererPool(2)
+    futures = [pool.submit("http://codev.co.uk") for i in range(4)]
+    for future in futures:
+        try:
+            print(future.result())
+        except Exception, e:
+            print(e)
+    pool.close()
+    print("Please check all four have rendered correctly")
@@ -24,24 +24,104 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
 
 import os
-import time
+import socket
 import pickle
+import optparse
 import getpass
 import imgur
+import backfill
+import cluster
+import journal
+import linkstore
+import metrics
+import pipeline
+import preflight
 import reddit
+import renderpool
+import transport
 import webshot
+import watchlist
+
+# How far back to search for links, see reddit.LINKS_FROM_SECONDS
+links_from = 'day'
+
+# Number of worker processes to render pages in, or 0 to render in this process
+render_processes = 2
+
+# How screenshots are encoded and how big they can get, for example
+# webshot.ImageOptions('JPEG', quality=80, max_height=10000) for smaller uploads
+image_options = webshot.ImageOptions()
+
+# What pages may load while being rendered, craigslist's stylesheets and
+# images are the same on every post so are cached between renders
+load_policy = webshot.LoadPolicy(blocked_types=['media'],
+                                 cache_directory=os.path.join(os.path.expanduser('~'), '.ric-cache'))
+
+# Pages are fetched (only the first preflight_bytes of them) before being
+# rendered and aren't rendered if they contain one of these, or are not
+# found. Set to None to render every page without checking it first
+removed_markers = preflight.CRAIGSLIST_REMOVED
+preflight_bytes = 32 * 1024
+
+# Port on localhost to serve Prometheus metrics on, or None to not serve them
+# Fetching /profile from it profiles the next item of each stage with cProfile
+# Each worker on a host needs its own port, pass it with --metrics-port
+metrics_port = 9464
+
+# Seconds between json log lines of the metrics, or None for no log lines
+metrics_log_interval = 10 * 60
+
+# To share the work between several ric processes, on this host or on others
+# through a network file system whose locks work (such as NFS with lockd),
+# set this to the same database file for each. Each process needs its own
+# worker name, to run more than one on a host pass each a name with --worker
+# and a metrics port with --metrics-port. Links are split between the
+# workers and one of them posts every comment. None runs a single process
+cluster_filename = None
+cluster_worker = socket.gethostname()
+
+# Running with --backfill WINDOW first catches up on the links posted in the
+# last WINDOW (such as day or week) after ric has been down, rendering and
+# uploading them with more processes and threads while their comments wait
+# their turn to be posted in the journal. The extra processes and threads
+# are kept until ric is restarted without --backfill. If it is interrupted,
+# run it again to carry on
+backfill_render_processes = 4
+backfill_uploaders = 6
+
+# The sites to watch for, links to each domain or its subdomains are rendered
+# Sites are searched for together so adding one rarely adds a search, for
+# example watchlist.Site('kijiji.ca', options=webshot.ImageOptions('JPEG', quality=80))
+watched_sites = watchlist.Watchlist([watchlist.Site('craigslist.org')])
 
 if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description='Watch reddit for links to pages that may be removed and post screenshots of them.')
+    parser.add_option('-b', '--backfill', metavar='WINDOW', choices=sorted(reddit.LINKS_FROM_SECONDS.keys()),
+                      help='first catch up on the links posted in the last WINDOW: %s' % (', '.join(sorted(reddit.LINKS_FROM_SECONDS.keys()))))
+    parser.add_option('-w', '--worker', default=cluster_worker, help='name of this worker if cluster_filename is set [%default]')
+    parser.add_option('-m', '--metrics-port', type='int', default=metrics_port,
+                      help='port to serve metrics on, 0 to not serve them [%default]')
+    options, args = parser.parse_args()
+
+    # Links older than this can't come up again, so are forgotten
+    max_age = 2 * max(reddit.LINKS_FROM_SECONDS[links_from], reddit.LINKS_FROM_SECONDS.get(options.backfill, 0))
+
     # Load the settings
-    # Is a tuple of (pages we have already processed so we don't repeat,
-    #                imgur key,
+    # Is a tuple of (imgur key,
     #                reddit username)
+    # Older versions stored a list of the pages we had already processed as
+    # the first item, these are moved into the link store below
     settings_filename = os.path.join(os.path.expanduser('~'), '.ric.pkl')
+    old_processed = []
     try:
         with open(settings_filename, 'rb') as settings:
-            processed, imgur_key, reddit_username = pickle.load(settings)
+            settings_values = pickle.load(settings)
+        if len(settings_values) == 3:
+            old_processed, imgur_key, reddit_username = settings_values
+        else:
+            imgur_key, reddit_username = settings_values
     except:
-        processed = []
         imgur_key = None
         reddit_username = None
 
@@ -57,68 +137,102 @@ if __name__ == '__main__':
     if reddit_username and not imgur_key:
         imgur_key = raw_input("Enter imgur.com api key: ")
 
+    # Join the other workers, dry-run mode always runs on its own
+    if cluster_filename and not dry_run:
+        coordinator = cluster.Coordinator(cluster_filename, options.worker, max_age=max_age)
+        journal_suffix = '-' + options.worker
+    else:
+        coordinator = None
+        journal_suffix = ''
+
+    # Open the store of pages we have already processed so we don't repeat
+    # Nothing is stored on disk in dry-run mode, workers share one store
+    if dry_run:
+        processed_filename = None
+    else:
+        processed_filename = os.path.join(os.path.expanduser('~'), '.ric.links')
+    if coordinator:
+        processed = cluster.SharedLinkStore(coordinator, max_age=max_age)
+    else:
+        processed = linkstore.LinkStore(processed_filename, max_age=max_age)
+    if old_processed:
+        processed.migrate(old_processed)
+
+    # Record each link's progress so a restart carries on where it left off
+    # and failed links are retried with backoff, screenshots waiting to be
+    # uploaded are kept in ~/.ric-journal, each worker keeps its own
+    if dry_run:
+        job_journal = journal.Journal()
+    else:
+        job_journal = journal.Journal(os.path.join(os.path.expanduser('~'), '.ric.journal' + journal_suffix),
+                                      os.path.join(os.path.expanduser('~'), '.ric-journal' + journal_suffix),
+                                      max_age=max_age)
+    if not dry_run:
+        with open(settings_filename, 'wb') as settings:
+            pickle.dump((imgur_key, reddit_username), settings)
+
+    # Page through the links we missed, saving how far we got in ~/.ric.backfill
+    if options.backfill:
+        if dry_run:
+            checkpoint_filename = None
+        else:
+            checkpoint_filename = os.path.join(os.path.expanduser('~'), '.ric.backfill' + journal_suffix)
+        catch_up = backfill.Backfill(watched_sites.queries(), options.backfill, checkpoint_filename,
+                                     accept_domain=watched_sites.accepts_domain)
+        if catch_up.resumed:
+            print("> Carrying on with the backfill from where it was interrupted")
+        if render_processes:
+            render_processes = max(render_processes, backfill_render_processes)
+        uploaders = backfill_uploaders
+    else:
+        catch_up = None
+        uploaders = 2
+
     # Create the app and webkit and renderer
-    renderer = webshot.WebshotRenderer()
-    imgur = imgur.ImgurApi(imgur_key)
-    reddit = reddit.RedditApi(reddit_username, reddit_password)
-
-    # This contains a list of links we couldn't process for one reason or another
-    # (may be because it appears on a NSFW reddit or just a network problem)
-    # They will be skipped for one round and ignored until we have completed examining all links
-    error_links = set()
-
-    # Load all the links from the last day mentioning craigslist
-    first = True
-    while True:
-        # Process all links on the page
-        uploaded = False
-        link = None
-        try:
-            for link in reddit.search('craigslist.org', 'new', 'day'):
-                # Skip links that caused problems for one loop only
-                if link in error_links:
-                    continue
-
-                # If the url is a link to craigslist examine it
-                if link.domain == 'craigslist.org' or link.domain.endswith('.craigslist.org'):
-                    # See if we have already processed it
-                    if link.href not in processed:
-                        # Get a screenshot of it
-                        filename = renderer.render(link.href)
-                        
-                        if dry_run:
-                            print("Created image for story\n    %s\n    %s\n    %s" % (link.title, link.comment_page(), filename))
-                            processed += [link.href] # Don't store settings in dry-run mode
-                        else:
-                            # Submit the screenshot to imgur.com
-                            imgur_link = imgur.upload_image(filename)
-                            print("Uploading image for story\n    %s\n    %s\n    %s" % (link.title, link.comment_page(), imgur_link))
-                            
-                            # Delete image
-                            os.unlink(filename)
-
-                            # Submit the link back to reddit
-                            reddit.submit_comment(link.comment_page(), 'Imgur cache: %s' % (imgur_link))
-
-                            # Mark this link as processed
-                            processed += [link.href]
-                            with open(settings_filename, 'wb') as settings:
-                                pickle.dump((processed, imgur_key, reddit_username), settings)
-
-                        # Skip to waiting for the next link
-                        uploaded = True
-                        break
-
-            # Saw all the links so reset the error set to allow us to try again
-            error_links = set()
-        except Exception, e:
-            print ('ERROR: %s' % str(e))
-            if link:
-                error_links.add(link.href)
-                
-        # Pause for 11 minutes before processing the list again to avoid reddit thinking 'FLOOD'
-        if uploaded or first:
-            print("> Waiting for 11 minutes or the next new story, whichever is sooner...")
-            first = False
-        time.sleep(660)
+    if render_processes:
+        renderer = renderpool.RendererPool(render_processes, options=image_options, policy=load_policy)
+    else:
+        renderer = webshot.WebshotRenderer(image_options, load_policy)
+    http = transport.HttpTransport()
+    imgur = imgur.ImgurApi(imgur_key, http)
+    reddit = reddit.RedditApi(reddit_username, reddit_password, http)
+    if removed_markers is None:
+        checker = None
+    else:
+        checker = preflight.PreflightChecker(http, removed_markers, preflight_bytes)
+
+    # Make the pipeline's metrics available while it runs
+    registry = metrics.Registry()
+    profiler = metrics.Profiler(os.path.expanduser('~'))
+    sinks = []
+    if options.metrics_port:
+        sinks += [metrics.MetricsServer(registry, options.metrics_port, profiler=profiler, stages=pipeline.STAGES)]
+    if metrics_log_interval:
+        sinks += [metrics.JsonLogger(registry, metrics_log_interval)]
+    for sink in sinks:
+        sink.start()
 
+    # Find links to the watched sites, render them, upload the screenshots
+    # and post the imgur links back to reddit until Ctrl-C is pressed
+    links = pipeline.Pipeline(reddit, imgur, renderer, processed, watched_sites.queries(), watched_sites.accepts_link,
+                              links_from=links_from, dry_run=dry_run, renderers=max(render_processes, 1),
+                              accept_domain=watched_sites.accepts_domain, registry=registry, profiler=profiler,
+                              options_for=watched_sites.options_for, job_journal=job_journal,
+                              preflight=checker, coordinator=coordinator, backfill=catch_up, uploaders=uploaders)
+    if coordinator:
+        coordinator.start()
+        print("> Joined %d other workers as %s" % (len(coordinator.workers()) - 1, options.worker))
+    print("> Watching reddit for new links, press Ctrl-C to stop...")
+    links.run()
+    if coordinator:
+        coordinator.stop()
+    for sink in sinks:
+        sink.stop()
+    if render_processes:
+        renderer.close()
+    http.close()
+    processed.close()
+    job_journal.close()
+    print(links.report())
+    if coordinator:
+        coordinator.close()
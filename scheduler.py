@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# scheduler.py
+# Decide how long to wait between polling reddit, posting comments and
+# retrying after errors
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import re
+import time
+import random
+import urllib2
+import threading
+
+# HTTP status codes that mean the server wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+
+def throttle_delay(error):
+    """
+    If error means we are being asked to slow down, return how many seconds
+    we were asked to wait for (0 if the server didn't say), otherwise None.
+    Understands HTTP 429 and 503 responses with an optional Retry-After
+    header and reddit's RATELIMIT error ("try again in 5 minutes").
+    """
+    if isinstance(error, urllib2.HTTPError) and error.code in THROTTLE_STATUS_CODES:
+        retry_after = error.info() and error.info().getheader('retry-after')
+        if retry_after and retry_after.strip().isdigit():
+            return int(retry_after)
+        return 0
+
+    message = str(error)
+    if 'RATELIMIT' in message:
+        wait = re.search(r'try again in (\d+) (second|minute)', message)
+        if wait:
+            return int(wait.group(1)) * (wait.group(2) == 'minute' and 60 or 1)
+        return 0
+    return None
+
+class Backoff:
+    """
+    Exponential backoff with jitter: after each consecutive failure the
+    longest possible wait doubles, and the actual wait is picked at random
+    up to it so several clients don't retry in step.
+    """
+
+    def __init__(self, base=5, maximum=15 * 60, factor=2):
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.failures = 0
+
+    def failed(self, minimum=0):
+        """
+        Record a failure and return how many seconds to wait before trying again,
+        which will be at least minimum (for example from a Retry-After header).
+        """
+        self.failures += 1
+        ceiling = min(self.maximum, self.base * self.factor ** (self.failures - 1))
+        return max(minimum, random.uniform(ceiling / 2.0, ceiling))
+
+    def succeeded(self):
+        """
+        Record a success, so the next failure waits the shortest time again.
+        """
+        self.failures = 0
+
+class PollScheduler:
+    """
+    Decides how long to wait before searching again. Searches are cheap so we
+    search often while links are turning up and slow down gradually when
+    nothing new is found, backing off further when searches fail.
+    """
+
+    def __init__(self, min_interval=15, max_interval=120, growth=1.5, backoff=None):
+        """
+        Polls are min_interval seconds apart after new links are found,
+        growing by growth each time nothing is found up to max_interval.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        if backoff is None:
+            backoff = Backoff(min_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def found(self, count):
+        """
+        Record a successful search that found count new links and return
+        how many seconds to wait before the next one.
+        """
+        self.backoff.succeeded()
+        if count:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.growth)
+        return self.interval
+
+    def failed(self, error):
+        """
+        Record a failed search and return how many seconds to wait before the next one.
+        """
+        return self.backoff.failed(max(self.interval, throttle_delay(error) or 0))
+
+class Cooldown:
+    """
+    Keeps actions such as posting comments at least interval seconds apart.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def wait(self, stop_event=None):
+        """
+        Block until the cooldown has passed and start a new one.
+        If stop_event is given and gets set while waiting, returns False early.
+        """
+        with self.__lock:
+            while True:
+                remaining = self.__next - time.time()
+                if remaining <= 0:
+                    break
+                if stop_event is None:
+                    time.sleep(remaining)
+                else:
+                    stop_event.wait(remaining)
+                    if stop_event.isSet():
+                        return False
+            self.__next = time.time() + self.interval
+            return True
+
+    def extend(self, seconds):
+        """
+        Push the next action back to at least seconds from now.
+        """
+        self.__next = max(self.__next, time.time() + seconds)
+
+if __name__ == '__main__':
+    # Show how the waits grow
+    polls = PollScheduler()
+    print("Poll intervals with nothing found: %s" % (', '.join(['%.0f' % (polls.found(0)) for i in range(6)])))
+    backoff = Backoff()
+    print("Backoff after failures: %s" % (', '.join(['%.0f' % (backoff.failed()) for i in range(8)])))
+    print("Reddit rate limit wait: %s" % (throttle_delay(RuntimeError('Error posting comment: RATELIMIT try again in 3 minutes'))))
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# transport.py
+# HTTP transport shared by the reddit and imgur apis which keeps connections
+# open between requests and accepts compressed responses
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import os
+import zlib
+import socket
+import select
+import httplib
+import urllib2
+import urlparse
+import cookielib
+import threading
+import StringIO
+
+# Errors that mean a kept-alive connection was closed by the server while idle
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error)
+# Only these are safe to send again when we can't tell if the server saw them
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+def body_length(piece):
+    """
+    Returns the number of bytes left to read from a string or file-like object.
+    """
+    if not hasattr(piece, 'read'):
+        return len(piece)
+    try:
+        return os.fstat(piece.fileno()).st_size - piece.tell()
+    except (AttributeError, IOError, OSError):
+        position = piece.tell()
+        piece.seek(0, os.SEEK_END)
+        size = piece.tell() - position
+        piece.seek(position)
+        return size
+
+def decode_body(body, content_encoding, partial=False):
+    """
+    Decompress a response body sent with the given Content-Encoding.
+    If partial the body may have been cut short and as much as can be
+    decompressed is returned.
+    """
+    content_encoding = (content_encoding or '').lower()
+    if content_encoding == 'gzip':
+        return _decompress(body, 16 + zlib.MAX_WBITS, partial)
+    if content_encoding == 'deflate':
+        # Some servers send raw deflate data without the zlib header
+        try:
+            return _decompress(body, zlib.MAX_WBITS, partial)
+        except zlib.error:
+            return _decompress(body, -zlib.MAX_WBITS, partial)
+    return body
+
+def _decompress(body, window_bits, partial):
+    if partial:
+        return zlib.decompressobj(window_bits).decompress(body)
+    return zlib.decompress(body, window_bits)
+
+class HttpResponse:
+    """
+    A complete response read from the server, with the body decompressed.
+    Has the same read(), close(), info() and code as a urllib2 response so
+    existing callers need not change.
+    """
+
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def close(self):
+        pass
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+class HttpTransport:
+    """
+    Sends HTTP requests over connections that are kept open and reused for
+    later requests to the same host. Responses may be gzip or deflate
+    compressed and cookies are kept in a cookielib.CookieJar, as a urllib2
+    opener with an HTTPCookieProcessor would.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self, cookiejar=None, connect_timeout=10, read_timeout=60, max_idle_per_host=4, max_redirects=5):
+        """
+        Create a transport, optionally using an existing cookie jar.
+        Timeouts are in seconds.
+        """
+        if cookiejar is None:
+            cookiejar = cookielib.CookieJar()
+        self.cookiejar = cookiejar
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.max_redirects = max_redirects
+
+        self.__idle = {} # (scheme, host, port) -> list of idle connections
+        self.__lock = threading.Lock()
+
+    def open(self, url, data=None, headers=None, max_bytes=None):
+        """
+        GET the url, or POST data to it if data is given, and return an
+        HttpResponse. Raises urllib2.HTTPError for error status codes just
+        as urllib2.urlopen does.
+        """
+        if data is None:
+            return self.request('GET', url, None, headers, max_bytes)
+        all_headers = { 'Content-Type': 'application/x-www-form-urlencoded' }
+        all_headers.update(headers or {})
+        return self.request('POST', url, data, all_headers, max_bytes)
+
+    def request(self, method, url, body=None, headers=None, max_bytes=None):
+        """
+        Send a request and return the HttpResponse, following redirects.
+        body may be a string or a list of strings and file-like objects which
+        are sent one after another without being joined together in memory.
+        Pass max_bytes to only read the start of the response body, the
+        connection is then closed rather than reused if there was more.
+        """
+        for redirect in range(self.max_redirects + 1):
+            response = self.__request_once(method, url, body, headers, max_bytes)
+            if response.code not in (301, 302, 303, 307) or not response.headers.getheader('location'):
+                break
+
+            # Follow the redirect, turning a POST into a GET as browsers do
+            url = urlparse.urljoin(url, response.headers.getheader('location'))
+            if response.code != 307:
+                method, body = 'GET', None
+                headers = dict([(name, value) for name, value in (headers or {}).items()
+                                if name.lower() not in ('content-type', 'content-length')])
+
+        if response.code >= 400:
+            raise urllib2.HTTPError(url, response.code, response.msg, response.headers, StringIO.StringIO(response.body))
+        return response
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def __request_once(self, method, url, body, headers, max_bytes):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = (parts.scheme, parts.hostname, parts.port)
+
+        # Let the cookie jar add its header using a urllib2 request as a stand in
+        cookie_request = urllib2.Request(url)
+        self.cookiejar.add_cookie_header(cookie_request)
+
+        all_headers = { 'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive' }
+        all_headers.update(cookie_request.unredirected_hdrs)
+        all_headers.update(headers or {})
+
+        if body is None:
+            pieces = []
+        elif isinstance(body, list):
+            pieces = body
+        else:
+            pieces = [body]
+        if body is not None:
+            all_headers['Content-Length'] = str(sum([body_length(piece) for piece in pieces]))
+
+        # An idle connection may have been closed by the server, in which case
+        # rewind any files in the body and try again once on a new connection.
+        # Once all the request has been sent the server may have acted on it,
+        # so only GET and HEAD are sent again and for other methods, such as
+        # posting a comment, the error goes back to the caller to decide
+        positions = [hasattr(piece, 'read') and piece.tell() for piece in pieces]
+        connection, reused = self.__get_connection(key)
+        while True:
+            sent = False
+            try:
+                self.__send(connection, method, path, all_headers, pieces)
+                sent = True
+                response = connection.getresponse()
+                break
+            except socket.timeout:
+                connection.close()
+                raise
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                for piece, position in zip(pieces, positions):
+                    if hasattr(piece, 'read'):
+                        piece.seek(position)
+                connection, reused = self.__get_connection(key, False)
+            except:
+                connection.close()
+                raise
+
+        try:
+            if max_bytes is None:
+                raw_body = response.read()
+            else:
+                raw_body = response.read(max_bytes)
+        except:
+            connection.close()
+            raise
+
+        # A connection with some of the body left unread can't be reused
+        if response.will_close or not response.isclosed():
+            connection.close()
+        else:
+            self.__put_connection(key, connection)
+
+        body = decode_body(raw_body, response.getheader('content-encoding'), max_bytes is not None)
+        result = HttpResponse(url, response.status, response.reason, response.msg, body)
+        self.cookiejar.extract_cookies(result, cookie_request)
+        return result
+
+    def __send(self, connection, method, path, headers, pieces):
+        connection.putrequest(method, path, skip_accept_encoding=True)
+        for name, value in headers.items():
+            connection.putheader(name, value)
+        connection.endheaders()
+        for piece in pieces:
+            if hasattr(piece, 'read'):
+                while True:
+                    chunk = piece.read(64 * 1024)
+                    if not chunk:
+                        break
+                    connection.send(chunk)
+            else:
+                connection.send(piece)
+
+    def __get_connection(self, key, reuse=True):
+        # Returns a connection and whether it has been used before
+        while reuse:
+            with self.__lock:
+                idle = self.__idle.get(key)
+                if not idle:
+                    break
+                connection = idle.pop()
+            if self.__is_open(connection):
+                return connection, True
+            connection.close()
+
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def __is_open(self, connection):
+        # An idle connection has nothing to read unless the server has closed it
+        if connection.sock is None:
+            return False
+        try:
+            readable, writable, errors = select.select([connection.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def __put_connection(self, key, connection):
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+if __name__ == '__main__':
+    # Test the class by fetching the same page twice over one connection
+    http = HttpTransport()
+    for i in range(2):
+        response = http.open('http://www.reddit.com/search.json?q=kant')
+        print("%d: %d bytes" % (response.code, len(response.read())))
+    http.close()
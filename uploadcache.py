@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# uploadcache.py
+# Remember the imgur links already made for each page and each screenshot
+# so duplicates don't have to be rendered or uploaded again
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+import re
+import time
+import hashlib
+import urllib
+import urlparse
+import threading
+import collections
+
+# Host name labels that only select a mobile or www version of the same page
+IGNORED_HOST_LABELS = ('www', 'm', 'mobile')
+
+def canonical_url(url):
+    """
+    Returns a key that is the same for every form of the same page's url.
+    The scheme and www/mobile host prefixes are ignored. Craigslist posts
+    are identified by their post id alone as the same post can be reached
+    through several paths, with any query string or fragment. Other pages
+    keep their path, fragment and query string, as sites such as kijiji
+    tell their pages apart by the query, with its parameters sorted by name.
+    """
+    parts = urlparse.urlsplit(url.strip())
+    labels = (parts.hostname or '').lower().split('.')
+    labels = [label for label in labels[:-2] if label not in IGNORED_HOST_LABELS] + labels[-2:]
+    host = '.'.join(labels)
+
+    if host == 'craigslist.org' or host.endswith('.craigslist.org'):
+        post = re.search(r'/(\d+)\.html?$', parts.path.rstrip('/'))
+        if post:
+            return 'craigslist.org/' + post.group(1)
+
+    key = host + parts.path
+    if parts.query:
+        params = urlparse.parse_qsl(parts.query, keep_blank_values=True)
+        params.sort(key=lambda param: param[0])
+        key += '?' + urllib.urlencode(params)
+    if parts.fragment:
+        key += '#' + parts.fragment
+    return key
+
+def image_hash(image):
+    """
+    Returns a hash of a screenshot's data (or list of tiles).
+    """
+    if not isinstance(image, list):
+        image = [image]
+    digest = hashlib.sha1()
+    for tile in image:
+        digest.update(tile)
+    return digest.hexdigest()
+
+class UploadCache:
+    """
+    Maps canonical page urls and screenshot hashes to the imgur links
+    uploaded for them. Entries are dropped once there are more than
+    max_entries or when they are older than max_age seconds.
+    Can be used from several threads at once.
+    """
+
+    def __init__(self, max_entries=5000, max_age=2 * 24 * 60 * 60):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        self.__entries = {} # key -> (imgur link, time added)
+        self.__order = collections.deque() # (time added, key), oldest first
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the imgur link for a canonical url or image hash, or None.
+        """
+        with self.__lock:
+            self.__evict()
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def add(self, imgur_link, *keys):
+        """
+        Remember the imgur link for each of the keys (canonical urls or image hashes).
+        """
+        now = time.time()
+        with self.__lock:
+            for key in keys:
+                self.__entries[key] = (imgur_link, now)
+                self.__order.append((now, key))
+            self.__evict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __evict(self):
+        cutoff = time.time() - self.max_age
+        while self.__order and (len(self.__entries) > self.max_entries or self.__order[0][0] < cutoff):
+            added, key = self.__order.popleft()
+            # Only drop the entry if it hasn't been replaced since
+            entry = self.__entries.get(key)
+            if entry is not None and entry[1] == added:
+                del self.__entries[key]
+
+if __name__ == '__main__':
+    # Show some canonical urls, the craigslist ones are all the same post
+    for url in ('http://sfbay.craigslist.org/sfc/apa/1234567890.html',
+                'https://sfbay.craigslist.org/sfc/apa/1234567890.html?lang=en#map',
+                'http://m.sfbay.craigslist.org/apa/1234567890.html/',
+                'http://www.kijiji.ca/v-view-details.html?adId=111&lang=en',
+                'http://kijiji.ca/v-view-details.html?lang=en&adId=111',
+                'http://kijiji.ca/v-view-details.html?adId=222'):
+        print("%s -> %s" % (url, canonical_url(url)))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# watchlist.py
+# The sites whose links are watched for on reddit, searched for together
+# and matched by domain, each with its own screenshot settings
+#
+# Author: Marc Sutton <ric@codev.co.uk>
+# Copyright (c) 2009 Codev Ltd
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
+
+class Site:
+    """
+    A site to watch for on reddit.
+    The domain matches itself and its subdomains, or only its subdomains if
+    it is written as '*.example.com'. The query is what to search reddit for
+    (the domain by default) and options are the webshot.ImageOptions to
+    render its pages with (None for the renderer's default).
+    """
+
+    def __init__(self, domain, query=None, options=None):
+        domain = domain.strip().lower().rstrip('.')
+        self.subdomains_only = domain.startswith('*.')
+        if self.subdomains_only:
+            domain = domain[2:]
+        if not domain or '*' in domain or '/' in domain:
+            raise ValueError('Not a domain or *.domain pattern: %s' % (domain))
+        self.domain = domain
+        self.query = query or domain
+        self.options = options
+
+    def __repr__(self):
+        return (self.subdomains_only and '*.' or '') + self.domain
+
+class Watchlist:
+    """
+    A set of Sites compiled into a suffix lookup so a link's domain is
+    matched with one dictionary lookup per label, however many sites there
+    are, and the most specific site wins. The sites' queries are OR'd
+    together into as few reddit searches as possible.
+    """
+
+    def __init__(self, sites, max_query_length=500):
+        """
+        Pass the Sites to watch and the longest search query to send reddit.
+        """
+        self.sites = list(sites)
+        self.max_query_length = max_query_length
+
+        self.__domains = {}
+        for site in self.sites:
+            if site.domain in self.__domains:
+                raise ValueError('%s is in the watchlist twice' % (site.domain))
+            self.__domains[site.domain] = site
+
+    def site_for(self, domain):
+        """
+        Returns the Site a domain belongs to, or None if it isn't watched.
+        """
+        domain = domain.lower().rstrip('.')
+        position = 0
+        while True:
+            site = self.__domains.get(domain[position:])
+            if site is not None and (position or not site.subdomains_only):
+                return site
+            position = domain.find('.', position) + 1
+            if not position:
+                return None
+
+    def accepts_domain(self, domain):
+        """
+        Returns True for domains of watched sites, for use as accept_domain in searches.
+        """
+        return self.site_for(domain) is not None
+
+    def accepts_link(self, link):
+        """
+        Returns True if the RedditLink points at a watched site.
+        """
+        return self.site_for(link.domain) is not None
+
+    def options_for(self, link):
+        """
+        Returns the webshot.ImageOptions to render a RedditLink's page with, or None for the default.
+        """
+        site = self.site_for(link.domain)
+        return site and site.options
+
+    def queries(self):
+        """
+        Returns the search queries that between them find every site, each
+        one several sites' queries OR'd together.
+        """
+        queries = []
+        current = ''
+        for query in self.__unique_queries():
+            if current and len(current) + len(' OR ') + len(query) > self.max_query_length:
+                queries += [current]
+                current = ''
+            current = current and current + ' OR ' + query or query
+        if current:
+            queries += [current]
+        return queries
+
+    def __unique_queries(self):
+        seen = set()
+        for site in self.sites:
+            if site.query not in seen:
+                seen.add(site.query)
+                yield site.query
+
+if __name__ == '__main__':
+    # Show how some domains are matched
+    watched = Watchlist([Site('craigslist.org'), Site('*.kijiji.ca'), Site('gumtree.com')], max_query_length=30)
+    print("Queries: %s" % (watched.queries()))
+    for domain in ('sfbay.craigslist.org', 'craigslist.org', 'kijiji.ca', 'toronto.kijiji.ca', 'notcraigslist.org'):
+        print("%s -> %s" % (domain, watched.site_for(domain)))
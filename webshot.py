@@ -22,83 +22,426 @@
 
 import os
 import sys
+import math
+import time
+import urlparse
 import tempfile
 
 try:
     import PyQt4.QtWebKit
     import PyQt4.QtGui
     import PyQt4.QtCore
+    import PyQt4.QtNetwork
 except:
     print("Failed to load PyQt4 - get it from http://www.riverbankcomputing.co.uk/software/pyqt/download")
     print(" or on Debian/Ubuntu run: sudo apt-get install python-qt4")
     sys.exit(1)
 
-class WebshotRenderer(PyQt4.QtWebKit.QWebPage):
+class ImageOptions:
     """
-    Class for rendering a webpage with webkit (via Qt).
+    How screenshots are encoded and how big they are allowed to get.
     """
 
-    def __init__(self):
+    # File extension for each format we know how to save
+    extensions = { 'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp' }
+
+    def __init__(self, format='PNG', quality=-1, compression=None, width=None, max_height=None, tile=False):
         """
-        Create the renderer.
+        format is one of PNG, JPEG or WEBP (if Qt has a plugin for it).
+        quality is 0-100 (or -1 for Qt's default) for lossy formats.
+        compression is the zlib level 0-9 for PNG, overriding quality.
+        Pages wider than width are scaled down to it.
+        Pages taller than max_height (after scaling) are cut off at it, or if
+        tile is True split into several images each at most max_height high.
+        """
+        format = format.upper()
+        if format == 'JPG':
+            format = 'JPEG'
+        if format not in self.extensions:
+            raise ValueError('format must be one of: PNG, JPEG, WEBP')
+        if compression is not None and not 0 <= compression <= 9:
+            raise ValueError('compression must be between 0 and 9')
+
+        self.format = format
+        self.quality = quality
+        self.compression = compression
+        self.width = width
+        self.max_height = max_height
+        self.tile = tile
+
+    def extension(self):
+        """
+        Returns the file extension for the format, including the dot.
+        """
+        return self.extensions[self.format]
+
+    def writer_quality(self):
+        """
+        Returns the quality value to pass to Qt when saving.
+        Qt's PNG writer turns quality into a zlib level with (100 - quality) * 9 / 91.
+        """
+        if self.format == 'PNG' and self.compression is not None:
+            return 100 - (self.compression * 91 + 8) / 9
+        return self.quality
+
+class LoadPolicy:
+    """
+    What a page is allowed to load, to cut down the time taken to render it.
+    """
+
+    # File extensions used to guess the type of a resource from its url
+    resource_types = {
+        'script': ['.js'],
+        'stylesheet': ['.css'],
+        'image': ['.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.ico', '.bmp'],
+        'font': ['.woff', '.woff2', '.ttf', '.otf', '.eot'],
+        'media': ['.mp3', '.mp4', '.ogg', '.webm', '.flv', '.swf'],
+    }
+
+    def __init__(self, blocked_domains=(), blocked_types=(), javascript=True, plugins=False, images=True,
+                 cache_directory=None, cache_megabytes=50, capture_early=False, capture_delay=0.5):
+        """
+        Requests to blocked_domains (or their subdomains) are never sent, nor
+        are requests for the blocked_types of resource (see resource_types).
+        javascript, plugins and images switch those features of webkit on or off.
+        If cache_directory is given responses are cached there on disk and
+        shared between every page loaded by the renderer.
+        With capture_early the page is captured capture_delay seconds after the
+        first layout (once the main document and its stylesheets are ready)
+        rather than waiting for everything else on the page to load.
+        """
+        for resource_type in blocked_types:
+            if resource_type not in self.resource_types:
+                raise ValueError('blocked_types must be from: %s' % (', '.join(sorted(self.resource_types))))
+
+        self.blocked_domains = [domain.lower().lstrip('.') for domain in blocked_domains]
+        self.blocked_extensions = []
+        for resource_type in blocked_types:
+            self.blocked_extensions += self.resource_types[resource_type]
+        self.javascript = javascript
+        self.plugins = plugins
+        self.images = images
+        self.cache_directory = cache_directory
+        self.cache_megabytes = cache_megabytes
+        self.capture_early = capture_early
+        self.capture_delay = capture_delay
+
+    def allows(self, url):
+        """
+        Returns True if the url may be loaded.
+        """
+        parts = urlparse.urlsplit(url)
+        host = parts.hostname or ''
+        for domain in self.blocked_domains:
+            if host == domain or host.endswith('.' + domain):
+                return False
+        extension = os.path.splitext(parts.path)[1].lower()
+        return extension not in self.blocked_extensions
+
+class PolicyNetworkAccessManager(PyQt4.QtNetwork.QNetworkAccessManager):
+    """
+    A network access manager that refuses requests a LoadPolicy doesn't allow
+    and caches responses on disk if the policy asks for it.
+    """
+
+    def __init__(self, policy):
+        PyQt4.QtNetwork.QNetworkAccessManager.__init__(self)
+        self.policy = policy
+        self.blocked = 0
+        if policy.cache_directory:
+            cache = PyQt4.QtNetwork.QNetworkDiskCache(self)
+            cache.setCacheDirectory(policy.cache_directory)
+            cache.setMaximumCacheSize(policy.cache_megabytes * 1024 * 1024)
+            self.setCache(cache)
+
+    def createRequest(self, operation, request, data=None):
+        if not self.policy.allows(str(request.url().toString())):
+            # A request for an empty url fails straight away without touching the network
+            self.blocked += 1
+            request = PyQt4.QtNetwork.QNetworkRequest(PyQt4.QtCore.QUrl())
+        return PyQt4.QtNetwork.QNetworkAccessManager.createRequest(self, operation, request, data)
+
+class WebshotPage(PyQt4.QtWebKit.QWebPage):
+    """
+    A webkit page that loads a url without blocking and calls back when the
+    page has finished loading or timed out.
+    """
+
+    def __init__(self, policy=None, network_manager=None):
+        """
+        Create the page, a QApplication must already exist.
+        Pass a LoadPolicy to control what the page loads, and a
+        PolicyNetworkAccessManager to share one (and its cache) between pages.
         """
-        self.application = PyQt4.QtGui.QApplication([])
         PyQt4.QtWebKit.QWebPage.__init__(self)
+        if policy is None:
+            policy = LoadPolicy()
+        self.policy = policy
+        if network_manager is None:
+            network_manager = PolicyNetworkAccessManager(policy)
+        self.network_manager = network_manager
+        self.setNetworkAccessManager(network_manager)
+
+        settings = self.settings()
+        settings.setAttribute(PyQt4.QtWebKit.QWebSettings.JavascriptEnabled, policy.javascript)
+        settings.setAttribute(PyQt4.QtWebKit.QWebSettings.PluginsEnabled, policy.plugins)
+        settings.setAttribute(PyQt4.QtWebKit.QWebSettings.AutoLoadImages, policy.images)
+
         self.loadFinished.connect(self.__load_finished)
+        self.mainFrame().initialLayoutCompleted.connect(self.__layout_completed)
         self.timer = PyQt4.QtCore.QTimer()
         self.timer.timeout.connect(self.__load_timeout)
         self.timer.setSingleShot(True)
-        self.timer.setInterval(5 * 60 * 100) # 5 minute timeout
+        self.capture_timer = PyQt4.QtCore.QTimer()
+        self.capture_timer.timeout.connect(self.__capture_early)
+        self.capture_timer.setSingleShot(True)
+        self.__callback = None
+        self.__load_started = None
+        self.stats = {}
 
-    def render(self, url, timeout_seconds=300):
+    def start_load(self, url, callback, timeout_seconds=300):
         """
-        Given a url return a temporary filename pointing to a png screenshot of the page.
-        It is the callers responsibility to delete or move the file when finished.
-        Pass a timeout in seconds if you want to override the default of 5 minutes.
+        Start loading url and return straight away.
+        callback(page, succeeded) is called from the Qt event loop when the
+        page has loaded (succeeded is True) or failed or timed out (False).
         """
-        # Generate a temporary file
-        filehandle, filename = tempfile.mkstemp(prefix='webshot', suffix='.png')
-        os.close(filehandle)
-
         # Set the viewport to a standard frame
-        frame_size = PyQt4.QtCore.QSize(800, 600)
-        self.setViewportSize(frame_size)
+        self.setViewportSize(PyQt4.QtCore.QSize(800, 600))
 
-        # Send the request and then loop until we get the complete or timeout signal
-        self.__render_result = None
-        self.mainFrame().load(PyQt4.QtCore.QUrl(url))
+        self.__callback = callback
+        self.__load_started = time.time()
+        self.stats = {}
+        self.timer.setInterval(int(timeout_seconds * 1000))
         self.timer.start()
-        while self.__render_result == None:
-            self.application.processEvents()
+        self.mainFrame().load(PyQt4.QtCore.QUrl(url))
 
-        # Stop the timer
-        self.timer.stop()
+    def save(self, options=None):
+        """
+        Save the loaded page to a temporary image file and return its filename,
+        or a list of filenames if options asks for the page to be tiled.
+        It is the callers responsibility to delete or move the files when finished.
+        Pass an ImageOptions to change the format and size from a full size png.
+        Details of the encoding are left in the stats dictionary.
+        """
+        if options is None:
+            options = ImageOptions()
 
-        # If we failed to render then throw an exception
-        if self.__render_result == False:
-            # Stop the browser so we don't get a later success message after a timeout
-            self.triggerAction(PyQt4.QtWebKit.QWebPage.Stop)
-            self.application.processEvents()
-            raise RuntimeError("Failed to render %s" % (url))
+        filenames = []
+        def save_tile(image):
+            # Generate a temporary file
+            filehandle, filename = tempfile.mkstemp(prefix='webshot', suffix=options.extension())
+            os.close(filehandle)
+            filenames.append(filename)
+            if image.save(filename, options.format, options.writer_quality()) == False: raise RuntimeError("Failed to save image")
+            return os.path.getsize(filename)
+
+        self.__encode(options, save_tile)
+        if options.tile:
+            return filenames
+        return filenames[0]
+
+    def save_data(self, options=None):
+        """
+        Return a screenshot of the loaded page as a string of bytes, or a list
+        of them if options asks for the page to be tiled, without writing to disk.
+        Otherwise the same as save().
+        """
+        if options is None:
+            options = ImageOptions()
+
+        tiles = []
+        def save_tile(image):
+            data = PyQt4.QtCore.QByteArray()
+            buffer = PyQt4.QtCore.QBuffer(data)
+            buffer.open(PyQt4.QtCore.QIODevice.WriteOnly)
+            if image.save(buffer, options.format, options.writer_quality()) == False: raise RuntimeError("Failed to save image")
+            buffer.close()
+            tiles.append(str(data))
+            return len(tiles[-1])
+
+        self.__encode(options, save_tile)
+        if options.tile:
+            return tiles
+        return tiles[0]
+
+    def __encode(self, options, save_tile):
+        # Paint the page and pass each tile of it to save_tile, which returns
+        # the number of bytes it took to encode
+        if str(options.format) not in [str(format).upper() for format in PyQt4.QtGui.QImageWriter.supportedImageFormats()]:
+            raise RuntimeError("This version of Qt can't save %s images" % (options.format))
+
+        started = time.time()
+        image = self.__paint(options)
+        painted = time.time()
+        self.stats['paint_seconds'] = painted - started
+        self.stats['format'] = options.format
+        self.stats['extension'] = options.extension()
+        self.stats['width'] = image.width()
+        self.stats['height'] = image.height()
+
+        if options.tile and options.max_height:
+            tops = range(0, image.height(), options.max_height)
+            tiles = [image.copy(0, top, image.width(), min(options.max_height, image.height() - top)) for top in tops]
+        else:
+            tiles = [image]
 
-        # Save the result into an image the size of the content
+        encoded_bytes = 0
+        for tile in tiles:
+            encoded_bytes += save_tile(tile)
+        self.stats['tiles'] = len(tiles)
+        self.stats['encoded_bytes'] = encoded_bytes
+        self.stats['encode_seconds'] = time.time() - painted
+
+    def __paint(self, options):
+        # Paint the page into an image the size of the content, only painting
+        # as much of a long page as we are going to keep
         frame_size = self.mainFrame().contentsSize()
+        scale = 1.0
+        if options.width and frame_size.width() > options.width:
+            scale = float(options.width) / frame_size.width()
+        if options.max_height and not options.tile:
+            frame_size.setHeight(min(frame_size.height(), int(math.ceil(options.max_height / scale))))
+
         self.setViewportSize(frame_size)
         image = PyQt4.QtGui.QImage(frame_size, PyQt4.QtGui.QImage.Format_RGB32)
         painter = PyQt4.QtGui.QPainter(image)
         if painter.isActive() == False: raise RuntimeError("Failed to create painter")
         self.mainFrame().render(painter)
         if painter.end() == False: raise RuntimeError("Failed to paint")
-        if image.save(filename) == False: raise RuntimeError("Failed to save image")
-        
-        return filename
+
+        if scale != 1.0:
+            image = image.scaledToWidth(options.width, PyQt4.QtCore.Qt.SmoothTransformation)
+            if options.max_height and not options.tile and image.height() > options.max_height:
+                image = image.copy(0, 0, image.width(), options.max_height)
+        return image
+
+    def __finish(self, result):
+        # Only report the first of the finished or timeout signals
+        callback = self.__callback
+        if callback is None:
+            return
+        self.__callback = None
+        self.timer.stop()
+        self.capture_timer.stop()
+        self.stats['load_seconds'] = time.time() - self.__load_started
+        if result == False:
+            # Stop the browser so we don't get a later success message after a timeout
+            self.triggerAction(PyQt4.QtWebKit.QWebPage.Stop)
+        callback(self, result)
 
     def __load_timeout(self):
-        self.__render_result = False
+        self.__finish(False)
+
+    def __layout_completed(self):
+        # The main document and its stylesheets are ready
+        if self.policy.capture_early and self.__callback is not None:
+            self.capture_timer.setInterval(int(self.policy.capture_delay * 1000))
+            self.capture_timer.start()
+
+    def __capture_early(self):
+        # Stop loading anything else and report the page as loaded
+        if self.__callback is None:
+            return
+        callback = self.__callback
+        self.__callback = None
+        self.triggerAction(PyQt4.QtWebKit.QWebPage.Stop)
+        self.__callback = callback
+        self.stats['captured_early'] = True
+        self.__finish(True)
 
     def __load_finished(self, result):
-        self.__render_result = result
+        self.__finish(result)
+
+class WebshotRenderer(WebshotPage):
+    """
+    Class for rendering a webpage with webkit (via Qt).
+    """
+
+    def __init__(self, options=None, policy=None):
+        """
+        Create the renderer.
+        Pass an ImageOptions to change how screenshots are saved by default
+        and a LoadPolicy to control what pages are allowed to load.
+        """
+        self.application = PyQt4.QtGui.QApplication([])
+        WebshotPage.__init__(self, policy)
+        self.__extra_pages = []
+        if options is None:
+            options = ImageOptions()
+        self.options = options
+
+    def render(self, url, timeout_seconds=300, as_data=False, options=None, with_stats=False):
+        """
+        Given a url return a temporary filename pointing to a png screenshot of the page.
+        It is the callers responsibility to delete or move the file when finished.
+        Pass a timeout in seconds if you want to override the default of 5 minutes.
+        Set as_data to True to get the png as a string of bytes instead of a file.
+        Pass an ImageOptions to override the renderer's options for this page.
+        Set with_stats to True to get a tuple of the result and a dictionary of
+        how long the load, paint and encode took and how big the image is.
+        """
+        result, stats = self.render_many([url], timeout_seconds, 1, as_data, options, True)[0]
+        if isinstance(result, Exception):
+            raise result
+        if with_stats:
+            return result, stats
+        return result
+
+    def render_many(self, urls, timeout_seconds=300, pages=4, as_data=False, options=None, with_stats=False):
+        """
+        Render several urls at once, loading up to pages of them at the same time.
+        Returns a list with the temporary filename (or the png data if as_data
+        is True) of the screenshot of each url, or the exception raised while
+        rendering it, in the same order as urls. With with_stats each item is a
+        tuple of the result and its stats, as for render().
+        """
+        if options is None:
+            options = self.options
+
+        # This page plus extra ones which are kept for the next call
+        while len(self.__extra_pages) < pages - 1:
+            self.__extra_pages += [WebshotPage(self.policy, self.network_manager)]
+        idle_pages = [self] + self.__extra_pages[:pages - 1]
+
+        results = [None] * len(urls)
+        stats = [None] * len(urls)
+        pending = list(enumerate(urls))
+        pending.reverse()
+        loop = PyQt4.QtCore.QEventLoop()
+        state = { 'loading': 0 }
+
+        def start_next(page):
+            index, url = pending.pop()
+            state['loading'] += 1
+            page.start_load(url, lambda page, succeeded: finished(page, index, succeeded), timeout_seconds)
+
+        def finished(page, index, succeeded):
+            state['loading'] -= 1
+            try:
+                if succeeded == False:
+                    raise RuntimeError("Failed to render %s" % (urls[index]))
+                if as_data:
+                    results[index] = page.save_data(options)
+                else:
+                    results[index] = page.save(options)
+            except Exception, e:
+                results[index] = e
+            stats[index] = page.stats
+            if pending:
+                start_next(page)
+            elif state['loading'] == 0:
+                loop.quit()
+
+        while pending and idle_pages:
+            start_next(idle_pages.pop())
+
+        # Wait in the event loop without using any CPU until every page is done
+        if state['loading']:
+            loop.exec_()
 
+        if with_stats:
+            return zip(results, stats)
+        return results
 
 if __name__ == '__main__':
     # Test the webkit rendering class
@@ -112,5 +455,8 @@ if __name__ == '__main__':
         print(webshot.render("http://codev.co.uk"))
     except Exception, e:
         print(e)
-    print("Please check both have rendered correctly")
+    print("Taking three screenshots of http://codev.co.uk at once to:")
+    for result in webshot.render_many(["http://codev.co.uk"] * 3, 60):
+        print(result)
+    print("Please check all have rendered correctly")
 